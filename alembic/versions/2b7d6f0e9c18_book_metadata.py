@@ -0,0 +1,34 @@
+"""Add book covers and the url metadata cache
+
+Revision ID: 2b7d6f0e9c18
+Revises: c41f8e2b6a95
+Create Date: 2026-10-19 12:04:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7d6f0e9c18'
+down_revision = 'c41f8e2b6a95'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('book', sa.Column('cover', sa.String(1024)))
+    op.add_column('book', sa.Column('enriched', sa.Boolean(),
+        server_default=sa.text('false')))
+
+    op.create_table('url_metadata',
+        sa.Column('url', sa.String(1024), primary_key=True),
+        sa.Column('title', sa.String(128)),
+        sa.Column('author', sa.String(64)),
+        sa.Column('cover', sa.String(1024)),
+        sa.Column('date_fetched', sa.DateTime()))
+
+
+def downgrade():
+    op.drop_table('url_metadata')
+
+    op.drop_column('book', 'enriched')
+    op.drop_column('book', 'cover')
@@ -0,0 +1,32 @@
+"""Cascade account deletes and tombstone large accounts
+
+Revision ID: 3f1c2a7d9b04
+Revises: None
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b04'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Let the database delete a user's books, so User.books can use
+    # passive_deletes.
+    op.drop_constraint('book_user_id_fkey', 'book', type_='foreignkey')
+    op.create_foreign_key('book_user_id_fkey', 'book', 'user',
+        ['user_id'], ['id'], ondelete='cascade')
+
+    op.add_column('user', sa.Column('date_deleted', sa.DateTime()))
+
+
+def downgrade():
+    op.drop_column('user', 'date_deleted')
+
+    op.drop_constraint('book_user_id_fkey', 'book', type_='foreignkey')
+    op.create_foreign_key('book_user_id_fkey', 'book', 'user',
+        ['user_id'], ['id'])
@@ -0,0 +1,27 @@
+"""Add the dashboard snapshot table
+
+Revision ID: 5d9b3e7a1c42
+Revises: 8a2e5c1f7d30
+Create Date: 2026-10-19 12:02:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d9b3e7a1c42'
+down_revision = '8a2e5c1f7d30'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('dashboard',
+        sa.Column('user_id', sa.Integer(),
+            sa.ForeignKey('user.id', ondelete='cascade'), primary_key=True),
+        sa.Column('version', sa.Integer()),
+        sa.Column('data', sa.Text()),
+        sa.Column('date_updated', sa.DateTime()))
+
+
+def downgrade():
+    op.drop_table('dashboard')
@@ -0,0 +1,25 @@
+"""Fingerprint books to find duplicates
+
+Revision ID: 7c2e4a6f1b83
+Revises: 9f5c1b8e2d07
+Create Date: 2026-10-19 12:07:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2e4a6f1b83'
+down_revision = '9f5c1b8e2d07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('book', sa.Column('fingerprint', sa.String(32)))
+    op.create_index('ix_book_user_id_fingerprint', 'book',
+        ['user_id', 'fingerprint'])
+
+
+def downgrade():
+    op.drop_index('ix_book_user_id_fingerprint', 'book')
+    op.drop_column('book', 'fingerprint')
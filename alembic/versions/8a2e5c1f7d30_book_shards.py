@@ -0,0 +1,24 @@
+"""Record the book storage shard of each user
+
+Revision ID: 8a2e5c1f7d30
+Revises: 3f1c2a7d9b04
+Create Date: 2026-10-19 12:01:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a2e5c1f7d30'
+down_revision = '3f1c2a7d9b04'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('shard', sa.String(32)))
+    op.add_column('user', sa.Column('shard_target', sa.String(32)))
+
+
+def downgrade():
+    op.drop_column('user', 'shard_target')
+    op.drop_column('user', 'shard')
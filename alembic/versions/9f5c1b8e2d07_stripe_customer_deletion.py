@@ -0,0 +1,28 @@
+"""Queue Stripe customer deletions
+
+Revision ID: 9f5c1b8e2d07
+Revises: e6a03c9d4b71
+Create Date: 2026-10-19 12:06:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9f5c1b8e2d07'
+down_revision = 'e6a03c9d4b71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('stripe_customer_deletion',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('stripe_id', sa.String(64)),
+        sa.Column('attempts', sa.Integer()),
+        sa.Column('last_error', sa.String(256)),
+        sa.Column('date_added', sa.DateTime()),
+        sa.Column('date_attempted', sa.DateTime()))
+
+
+def downgrade():
+    op.drop_table('stripe_customer_deletion')
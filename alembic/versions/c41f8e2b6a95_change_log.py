@@ -0,0 +1,40 @@
+"""Add the change log for delta sync
+
+Revision ID: c41f8e2b6a95
+Revises: 5d9b3e7a1c42
+Create Date: 2026-10-19 12:03:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c41f8e2b6a95'
+down_revision = '5d9b3e7a1c42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('changelog_floor', sa.Integer(),
+        server_default='0'))
+    op.add_column('user', sa.Column('changelog_seq', sa.Integer(),
+        server_default='0'))
+
+    op.create_table('change',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(),
+            sa.ForeignKey('user.id', ondelete='cascade')),
+        sa.Column('seq', sa.Integer()),
+        sa.Column('book_id', sa.Integer()),
+        sa.Column('deleted', sa.Boolean()),
+        sa.Column('date_added', sa.DateTime()))
+    op.create_index('ix_change_user_id_seq', 'change', ['user_id', 'seq'],
+        unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_change_user_id_seq', 'change')
+    op.drop_table('change')
+
+    op.drop_column('user', 'changelog_seq')
+    op.drop_column('user', 'changelog_floor')
@@ -0,0 +1,26 @@
+"""Add the set co-occurrence graph
+
+Revision ID: e6a03c9d4b71
+Revises: 2b7d6f0e9c18
+Create Date: 2026-10-19 12:05:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6a03c9d4b71'
+down_revision = '2b7d6f0e9c18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('set_graph',
+        sa.Column('user_id', sa.Integer(),
+            sa.ForeignKey('user.id', ondelete='cascade'), primary_key=True),
+        sa.Column('version', sa.Integer()),
+        sa.Column('data', sa.Text()))
+
+
+def downgrade():
+    op.drop_table('set_graph')
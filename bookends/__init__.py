@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from functools import wraps
+import sqlite3
 from werkzeug.contrib.fixers import ProxyFix
 
 import stripe
@@ -10,6 +11,8 @@ from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.bcrypt import Bcrypt
 from flask.ext.login import LoginManager, current_user
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm.interfaces import SessionExtension
 
 app = Flask(__name__, instance_relative_config=True)
@@ -17,8 +20,37 @@ app.config.from_object('config')
 app.config.from_pyfile('config.py')
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
+from . import templating
+templating.install_bytecode_cache()
+
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """
+    Make SQLite enforce foreign keys, and so ON DELETE CASCADE, and leave
+    starting transactions to begin_sqlite().
+
+    pysqlite's own transaction handling commits before a SAVEPOINT, which
+    breaks db.session.begin_nested().
+
+    """
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+@event.listens_for(Engine, 'begin')
+def begin_sqlite(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.connection.execute('BEGIN')
+
+from . import sharding
+sharding.install(db)
+
 bcrypt = Bcrypt(app)
 
 stripe.api_key = app.config["STRIPE_API_KEY"]
@@ -47,6 +79,28 @@ def check_expired(f):
 
     return decorated_function
 
+def lock_library(f):
+    """
+    A decorator for views that write a user's books or sets.
+
+    Locks the user's row until the request ends, so sharding.move_user()
+    waits for writes in flight, and refuses to write while a move is running.
+
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user.is_authenticated() and request.method == "POST":
+            user = User.query.filter(User.id == current_user.id).with_lockmode(
+                'update').populate_existing().one()
+
+            if user.shard_target is not None:
+                flash("Your library is being moved. Please try again in a minute.")
+                return redirect(url_for('index'))
+        return f(*args, **kwargs)
+
+    return decorated_function
+
 from . import views
 
 from .models import User, Book, Set
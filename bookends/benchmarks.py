@@ -0,0 +1,95 @@
+"""Compare the ORM and read-model paths of the listing pages."""
+import sys
+import time
+
+from . import app, db
+from .models import User, Book, book_rows
+from .querybudget import scratch_database, seed
+
+
+PAGE = """{% from "macros.html" import book_card %}
+{% for book in books %}{{ book_card(book) }}{% endfor %}"""
+
+
+def footprint(books, parts):
+    """Approximate bytes held by what parts() yields for each book.
+
+    Objects shared between books, such as a Set in many books, are counted
+    once.
+
+    """
+
+    sizes = {}
+
+    for book in books:
+        for part in parts(book):
+            sizes[id(part)] = sys.getsizeof(part)
+
+    return sum(sizes.values())
+
+
+def values(book):
+    """The displayed values of a book and its sets, on either path."""
+
+    return [book.title, book.author, book.url, book.cover] + \
+        [set.title for set in book.sets]
+
+
+def orm_parts(book):
+    """A loaded Book, its sets, their instance state and their values."""
+
+    for instance in [book] + list(book.sets):
+        state = instance._sa_instance_state
+
+        for part in (instance, instance.__dict__, state, state.__dict__):
+            yield part
+
+    yield book.sets
+
+    for value in values(book):
+        yield value
+
+
+def row_parts(row):
+    """A BookRow, its SetRows and their values."""
+
+    for part in [row, row.sets] + list(row.sets) + values(row):
+        yield part
+
+
+def bench_listing(size):
+    """Return (load seconds, render seconds, bytes per row) for the ORM
+    path and the read-model path over a library of size books."""
+
+    results = []
+
+    with scratch_database():
+        with app.app_context():
+            user_id = seed(size)['user_id']
+
+        loaders = [
+            (lambda user: user.books.options(db.joinedload(Book.sets)).all(),
+             orm_parts),
+            (lambda user: book_rows(user.books), row_parts),
+        ]
+
+        page = app.jinja_env.from_string(PAGE)
+
+        for load, parts in loaders:
+            with app.test_request_context():
+                user = User.query.get(user_id)
+
+                start = time.time()
+                books = load(user)
+                loaded = time.time() - start
+
+                start = time.time()
+                page.render(books=books)
+                rendered = time.time() - start
+
+                results.append((loaded, rendered,
+                    footprint(books, parts) / len(books)))
+
+                db.session.remove()
+
+    return results
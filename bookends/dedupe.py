@@ -0,0 +1,159 @@
+"""Merge duplicate books.
+
+Books with the same user and fingerprint are duplicates. The one added
+first (by date_added, as ids are reassigned when sharding moves a user) is
+kept. It gains the reading, exciting and finished flags, the set
+memberships and, if it has none, the url and cover of the others, which
+are then deleted. Each step is a single statement per shard, whatever the
+number of duplicates.
+
+"""
+from collections import defaultdict
+
+from sqlalchemy import text
+
+from . import db, sharding
+from .models import Book, Dashboard, SetGraph, User
+
+
+# The order books were added in, oldest first.
+AGE = "%(b)s.date_added IS NULL, %(b)s.date_added, %(b)s.id"
+
+# Every duplicate book with the book it's merged into.
+DUPLICATES = """
+    SELECT b.user_id, b.id AS duplicate_id, k.id AS keeper_id
+    FROM book b JOIN book k
+        ON b.user_id = k.user_id AND b.fingerprint = k.fingerprint
+    WHERE k.id = (
+        SELECT k2.id FROM book k2
+        WHERE k2.user_id = k.user_id AND k2.fingerprint = k.fingerprint
+        ORDER BY %s
+        LIMIT 1
+    ) AND b.id != k.id
+""" % (AGE % {'b': 'k2'})
+
+# The duplicates of the keeper being updated that match a condition,
+# oldest first.
+KEEPER_DUPLICATES = """
+    FROM book b
+    WHERE b.user_id = book.user_id AND b.fingerprint = book.fingerprint
+        AND b.id != book.id AND %%s
+    ORDER BY %s
+""" % (AGE % {'b': 'b'})
+
+KEEPERS = "id IN (SELECT keeper_id FROM (%s) d)" % DUPLICATES
+
+MERGE_FLAGS = """
+    UPDATE book SET
+        reading = reading OR EXISTS (SELECT 1 %(reading)s),
+        exciting = exciting OR EXISTS (SELECT 1 %(exciting)s),
+        finished = finished OR EXISTS (SELECT 1 %(finished)s)
+    WHERE %(keepers)s
+""" % dict(keepers=KEEPERS, **dict(
+    (flag, KEEPER_DUPLICATES % ('b.' + flag)) for flag in (
+        'reading', 'exciting', 'finished')))
+
+# A keeper without a url takes the url, cover and enriched flag of its
+# oldest duplicate with one.
+HAS_URL = KEEPER_DUPLICATES % "b.url IS NOT NULL AND b.url != ''"
+
+MERGE_URLS = """
+    UPDATE book SET
+        url = (SELECT b.url %(has_url)s LIMIT 1),
+        cover = (SELECT b.cover %(has_url)s LIMIT 1),
+        enriched = (SELECT b.enriched %(has_url)s LIMIT 1)
+    WHERE (url IS NULL OR url = '') AND EXISTS (SELECT 1 %(has_url)s)
+        AND %(keepers)s
+""" % {'has_url': HAS_URL, 'keepers': KEEPERS}
+
+# A keeper without a cover takes one found for the same url.
+HAS_COVER = KEEPER_DUPLICATES % "b.url = book.url AND b.cover IS NOT NULL"
+
+MERGE_COVERS = """
+    UPDATE book SET
+        cover = (SELECT b.cover %(has_cover)s LIMIT 1)
+    WHERE cover IS NULL AND EXISTS (SELECT 1 %(has_cover)s)
+        AND %(keepers)s
+""" % {'has_cover': HAS_COVER, 'keepers': KEEPERS}
+
+MERGE_SETS = """
+    INSERT INTO sets (set_id, book_id)
+    SELECT DISTINCT s.set_id, d.keeper_id
+    FROM sets s JOIN (%s) d ON s.book_id = d.duplicate_id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM sets s2
+        WHERE s2.set_id = s.set_id AND s2.book_id = d.keeper_id
+    )
+""" % DUPLICATES
+
+DELETE_SETS = """
+    DELETE FROM sets WHERE book_id IN (SELECT duplicate_id FROM (%s) d)
+""" % DUPLICATES
+
+DELETE_BOOKS = """
+    DELETE FROM book WHERE id IN (SELECT duplicate_id FROM (%s) d)
+""" % DUPLICATES
+
+
+def backfill_fingerprints(chunk_size):
+    """Fingerprint the books saved before fingerprints existed."""
+
+    while True:
+        books = Book.query.filter(Book.fingerprint == None).limit(
+            chunk_size).all()
+
+        if not books:
+            break
+
+        for book in books:
+            book._update_fingerprint('title', book.title)
+            db.session.add(book)
+
+        db.session.commit()
+
+
+def dedupe(chunk_size):
+    """Merge duplicates on every shard and yield the number removed per shard.
+
+    The merged users' sync clients are told about the deleted books, and
+    their dashboard snapshots and set graphs are rebuilt on next use.
+
+    """
+
+    for key in sharding.all_shards():
+        with sharding.use_shard(key):
+            backfill_fingerprints(chunk_size)
+
+            engine = sharding.get_engine(key)
+
+            duplicates = db.session.execute(text(DUPLICATES), bind=engine).fetchall()
+
+            if not duplicates:
+                yield 0
+                continue
+
+            for statement in (MERGE_FLAGS, MERGE_URLS, MERGE_COVERS, MERGE_SETS,
+                    DELETE_SETS, DELETE_BOOKS):
+                db.session.execute(text(statement), bind=engine)
+
+            changes = defaultdict(list)
+
+            for row in duplicates:
+                changes[row.user_id].append((row.duplicate_id, True))
+
+            for user_id, keeper_id in set(
+                    (row.user_id, row.keeper_id) for row in duplicates):
+                changes[user_id].append((keeper_id, False))
+
+            users = list(changes)
+
+            for user in User.query.filter(User.id.in_(users)).all():
+                user.log_changes(changes[user.id])
+
+            for model in (Dashboard, SetGraph):
+                model.query.filter(model.user_id.in_(users)).delete(
+                    synchronize_session=False)
+
+            db.session.commit()
+
+            yield len(duplicates)
@@ -0,0 +1,151 @@
+"""A local stand-in for the pages books link to, for development and tests.
+
+Every path serves a page with a title, author and cover, and /slow answers
+after a delay. check() runs the metadata fetcher against it.
+
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import timedelta
+from SocketServer import ThreadingMixIn
+import threading
+import time
+
+from . import app, db
+
+
+PAGE = """<html><head><title>Title %s</title>
+<meta name="author" content="Author">
+<meta property="og:image" content="http://example.com/cover.jpg">
+</head><body></body></html>"""
+
+
+class FakePageHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, time.time()))
+
+        if self.path == '/slow':
+            time.sleep(self.server.delay)
+
+        data = PAGE % self.path
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePageServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that time out on /slow close the connection first.
+        pass
+
+
+def create_server(port, delay=2):
+    """Return a server for fake pages, where /slow takes delay seconds."""
+
+    server = FakePageServer(('localhost', port), FakePageHandler)
+    server.requests = []
+    server.delay = delay
+
+    return server
+
+
+def check():
+    """Fetch metadata from the fake pages and return a list of what went
+    wrong, empty if pages are parsed, slow pages time out, requests to a
+    host are spaced out, the url_metadata cache is used until it expires
+    and local hosts are refused by default.
+
+    """
+
+    from .metadata import MetadataFetcher, lookup
+    from .models import UrlMetadata
+    from .querybudget import scratch_database
+
+    timeout, interval = 0.5, 0.2
+
+    server = create_server(0)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base = 'http://localhost:%d' % server.server_port
+
+    fetcher = MetadataFetcher(workers=4, timeout=timeout,
+        host_interval=interval, max_bytes=64 * 1024,
+        allow_private_hosts=True)
+
+    problems = []
+
+    try:
+        metadata = fetcher.fetch(base + '/book')
+
+        if metadata != {'title': 'Title /book', 'author': 'Author',
+                        'cover': 'http://example.com/cover.jpg'}:
+            problems.append('/book was parsed as %r' % metadata)
+
+        start = time.time()
+
+        if fetcher.fetch(base + '/slow'):
+            problems.append('/slow did not time out')
+
+        if time.time() - start > timeout + 1:
+            problems.append('/slow took %.1fs to time out' % (
+                time.time() - start))
+
+        del server.requests[:]
+        fetcher.fetch_all([base + '/%d' % i for i in range(3)])
+
+        times = sorted(when for path, when in server.requests)
+
+        if len(times) != 3 or min(b - a for a, b in zip(times, times[1:])) < \
+                interval * 0.9:
+            problems.append('requests to one host were not %.1fs apart' %
+                interval)
+
+        with scratch_database():
+            with app.app_context():
+                db.create_all()
+
+                url = base + '/cached'
+                del server.requests[:]
+
+                lookup(fetcher, [url])
+                lookup(fetcher, [url])
+
+                if len(server.requests) != 1:
+                    problems.append('a cached url was fetched %d times' %
+                        len(server.requests))
+
+                row = UrlMetadata.query.get(url)
+                row.date_fetched -= timedelta(
+                    days=app.config['METADATA_TTL_DAYS'] + 1)
+                db.session.commit()
+
+                lookup(fetcher, [url])
+
+                if len(server.requests) != 2:
+                    problems.append('an expired url was not fetched again')
+
+        del server.requests[:]
+
+        refusing = MetadataFetcher(workers=1, timeout=timeout,
+            host_interval=0, max_bytes=1024)
+
+        if refusing.fetch(base + '/book') or server.requests:
+            problems.append('a local url was fetched with private hosts refused')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return problems
@@ -0,0 +1,138 @@
+"""A local stand-in for the Stripe API, for development and tests.
+
+Serves the customer endpoints StripeGateway uses from memory. Point
+STRIPE_API_BASE at it, e.g. http://localhost:12111. check() runs
+payments.process_customer_deletions() against it.
+
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import re
+import threading
+
+from . import app, db
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        data = json.dumps(body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def customer_id(self):
+        match = re.match(r'^/v1/customers/([\w-]+)$', self.path)
+
+        return match and match.group(1)
+
+    def do_GET(self):
+        customer_id = self.customer_id()
+
+        if customer_id in self.server.customers:
+            self.send_json(200, {'id': customer_id, 'object': 'customer'})
+        else:
+            self.send_json(404, {'error': {'type': 'invalid_request_error'}})
+
+    def do_DELETE(self):
+        customer_id = self.customer_id()
+
+        if self.server.failures.get(customer_id, 0) > 0:
+            self.server.failures[customer_id] -= 1
+            self.send_json(503, {'error': {'type': 'api_error'}})
+        elif customer_id in self.server.customers:
+            self.server.customers.remove(customer_id)
+            self.send_json(200, {'id': customer_id, 'deleted': True})
+        else:
+            self.send_json(404, {'error': {'type': 'invalid_request_error'}})
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(port, customers=(), failures=None):
+    """Return an HTTPServer that knows about the given customer ids.
+
+    failures maps customer ids to the number of deletes that get a 503
+    before one succeeds.
+
+    """
+
+    server = HTTPServer(('localhost', port), FakeStripeHandler)
+    server.customers = set(customers)
+    server.failures = dict(failures or {})
+
+    return server
+
+
+def check():
+    """Delete customers through the fake server and return a list of what
+    went wrong, empty if deletions succeed, are retried on 5xx responses,
+    count a 404 as deleted and are kept for later when Stripe stays down.
+
+    """
+
+    from . import payments
+    from .models import StripeCustomerDeletion
+    from .querybudget import scratch_database
+
+    server = create_server(0, customers=['cus_ok', 'cus_flaky', 'cus_down'],
+        failures={'cus_flaky': 2, 'cus_down': 100})
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    gateway = payments.gateway
+    payments.gateway = payments.StripeGateway(api_key='sk_test',
+        api_base='http://localhost:%d' % server.server_port, timeout=5,
+        retries=3, backoff=0, pool_size=1)
+
+    problems = []
+
+    try:
+        with scratch_database():
+            with app.app_context():
+                db.create_all()
+
+                for stripe_id in ('cus_ok', 'cus_flaky', 'cus_gone', 'cus_down'):
+                    db.session.add(StripeCustomerDeletion(stripe_id=stripe_id))
+
+                db.session.commit()
+
+                errors = dict((deletion.stripe_id, error) for deletion, error
+                    in payments.process_customer_deletions())
+
+                for stripe_id in ('cus_ok', 'cus_flaky', 'cus_gone'):
+                    if errors.get(stripe_id) is not None:
+                        problems.append('%s failed: %s' % (
+                            stripe_id, errors[stripe_id]))
+
+                if server.customers != set(['cus_down']):
+                    problems.append('customers left on Stripe: %s' % ', '.join(
+                        sorted(server.customers)))
+
+                if server.failures['cus_flaky']:
+                    problems.append('cus_flaky was not retried')
+
+                if errors.get('cus_down') is None:
+                    problems.append('cus_down did not fail')
+
+                remaining = [(deletion.stripe_id, deletion.attempts) for
+                    deletion in StripeCustomerDeletion.query.all()]
+
+                if remaining != [('cus_down', 1)]:
+                    problems.append('deletions left: %r' % remaining)
+    finally:
+        payments.gateway.session.close()
+        payments.gateway = gateway
+        server.shutdown()
+        server.server_close()
+
+    return problems
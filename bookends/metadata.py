@@ -0,0 +1,432 @@
+"""Fetch page metadata (title, author, cover) for the urls on books.
+
+Fetching is done by a pool of worker threads sharing one pooled HTTP
+session. Requests to the same host are spaced HOST_INTERVAL seconds apart
+and results, including failures, are cached in the url_metadata table for
+METADATA_TTL_DAYS so a popular url is only fetched once.
+
+Urls are user supplied, so every connection, including those made for
+redirects, is refused unless its host resolves only to public addresses,
+and goes to the address that was checked. Otherwise books could be used to
+read services on the private network. METADATA_ALLOW_PRIVATE_HOSTS lifts
+this for fetching from a local server.
+
+"""
+from binascii import hexlify
+from datetime import datetime, timedelta
+from httplib import HTTPConnection
+from HTMLParser import HTMLParser, HTMLParseError
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+import socket
+import ssl
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+    HTTPSConnectionPool, VerifiedHTTPSConnection)
+from requests.packages.urllib3.packages.ssl_match_hostname import match_hostname
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+from requests.packages.urllib3.util import (assert_fingerprint,
+    resolve_cert_reqs, resolve_ssl_version, ssl_wrap_socket)
+
+from . import app, db, sharding
+from .models import Book, UrlMetadata
+
+
+def _address_value(family, address):
+    return int(hexlify(socket.inet_pton(family, address)), 16)
+
+
+def _networks(family, bits, networks):
+    return [(_address_value(family, address) >> (bits - prefix), bits - prefix)
+        for address, prefix in networks]
+
+# Private, loopback, link-local, shared, multicast and reserved networks
+BLOCKED_IPV4 = _networks(socket.AF_INET, 32, [
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8),
+    ('169.254.0.0', 16), ('172.16.0.0', 12), ('192.0.0.0', 24),
+    ('192.168.0.0', 16), ('198.18.0.0', 15), ('224.0.0.0', 4),
+    ('240.0.0.0', 4)])
+
+BLOCKED_IPV6 = _networks(socket.AF_INET6, 128, [
+    ('::', 96), ('fc00::', 7), ('fe80::', 10), ('fec0::', 10), ('ff00::', 8)])
+
+# Networks that embed an IPv4 address in their last 32 bits
+EMBEDDED_IPV4 = _networks(socket.AF_INET6, 128, [
+    ('::ffff:0:0', 96), ('64:ff9b::', 96)])
+
+
+def _in_networks(value, networks):
+    return any(value >> shift == network for network, shift in networks)
+
+
+def is_public_address(address):
+    """Return whether an IPv4 or IPv6 address is reachable on the internet."""
+
+    if ':' not in address:
+        return not _in_networks(_address_value(socket.AF_INET, address),
+            BLOCKED_IPV4)
+
+    value = _address_value(socket.AF_INET6, address.split('%')[0])
+
+    if _in_networks(value, EMBEDDED_IPV4):
+        return not _in_networks(value & 0xffffffff, BLOCKED_IPV4)
+
+    return not _in_networks(value, BLOCKED_IPV6)
+
+
+class PrivateHostError(socket.error):
+    pass
+
+
+def connect_checked(host, port, timeout, allow_private):
+    """Return a socket connected to a host, refusing hosts that resolve to
+    any address that isn't public.
+
+    The host is resolved once and the socket connects to an address that
+    was checked, so DNS can't answer differently for the connection.
+
+    """
+
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    if not allow_private:
+        for address in addresses:
+            if not is_public_address(address[4][0]):
+                raise PrivateHostError('%s resolves to %s' % (
+                    host, address[4][0]))
+
+    error = socket.error('%s resolves to no addresses' % host)
+
+    for family, socktype, proto, _, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+
+        try:
+            if isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+
+            sock.connect(address)
+
+            return sock
+        except socket.error as e:
+            error = e
+            sock.close()
+
+    raise error
+
+
+class CheckedHTTPConnection(HTTPConnection):
+
+    allow_private = False
+
+    def connect(self):
+        self.sock = connect_checked(self.host, self.port, self.timeout,
+            self.allow_private)
+
+
+class CheckedHTTPSConnection(VerifiedHTTPSConnection):
+    """VerifiedHTTPSConnection.connect(), on a checked socket. The host
+    name is still used for SNI and to match the certificate."""
+
+    allow_private = False
+
+    def connect(self):
+        sock = connect_checked(self.host, self.port, self.timeout,
+            self.allow_private)
+
+        cert_reqs = resolve_cert_reqs(self.cert_reqs)
+
+        self.sock = ssl_wrap_socket(sock, self.key_file, self.cert_file,
+            cert_reqs=cert_reqs, ca_certs=self.ca_certs,
+            server_hostname=self.host,
+            ssl_version=resolve_ssl_version(self.ssl_version))
+
+        if cert_reqs != ssl.CERT_NONE:
+            if self.assert_fingerprint:
+                assert_fingerprint(self.sock.getpeercert(binary_form=True),
+                    self.assert_fingerprint)
+            else:
+                match_hostname(self.sock.getpeercert(),
+                    self.assert_hostname or self.host)
+
+
+class CheckedHTTPConnectionPool(HTTPConnectionPool):
+
+    def _new_conn(self):
+        self.num_connections += 1
+
+        connection = CheckedHTTPConnection(host=self.host, port=self.port,
+            strict=self.strict)
+        connection.allow_private = self.allow_private
+
+        return connection
+
+
+class CheckedHTTPSConnectionPool(HTTPSConnectionPool):
+
+    def _new_conn(self):
+        self.num_connections += 1
+
+        connection = CheckedHTTPSConnection(host=self.host, port=self.port,
+            strict=self.strict)
+        connection.set_cert(key_file=self.key_file, cert_file=self.cert_file,
+            cert_reqs=self.cert_reqs, ca_certs=self.ca_certs,
+            assert_hostname=self.assert_hostname,
+            assert_fingerprint=self.assert_fingerprint)
+        connection.ssl_version = self.ssl_version
+        connection.allow_private = self.allow_private
+
+        return connection
+
+
+class CheckedPoolManager(PoolManager):
+
+    pool_classes = {
+        'http': CheckedHTTPConnectionPool,
+        'https': CheckedHTTPSConnectionPool,
+    }
+
+    def __init__(self, allow_private, **kwargs):
+        PoolManager.__init__(self, **kwargs)
+        self.allow_private = allow_private
+
+    def _new_pool(self, scheme, host, port):
+        kwargs = self.connection_pool_kw.copy()
+
+        if scheme == 'http':
+            for keyword in SSL_KEYWORDS:
+                kwargs.pop(keyword, None)
+
+        pool = self.pool_classes[scheme](host, port, **kwargs)
+        pool.allow_private = self.allow_private
+
+        return pool
+
+
+class CheckedAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connections only go to public addresses."""
+
+    def __init__(self, allow_private=False, **kwargs):
+        self.allow_private = allow_private
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self.poolmanager = CheckedPoolManager(self.allow_private,
+            num_pools=connections, maxsize=maxsize, block=block)
+
+
+class MetadataParser(HTMLParser):
+    """Pull the title, author and cover image out of a page's <head>."""
+
+    PROPERTIES = {
+        'og:title': 'title',
+        'twitter:title': 'title',
+        'book:author': 'author',
+        'author': 'author',
+        'og:image': 'cover',
+        'twitter:image': 'cover',
+    }
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.metadata = {}
+        self._in_title = False
+        self._title = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+
+        if tag == 'title':
+            self._in_title = True
+        elif tag == 'meta':
+            name = (attrs.get('property') or attrs.get('name') or '').lower()
+            field = self.PROPERTIES.get(name)
+
+            if field and attrs.get('content') and field not in self.metadata:
+                self.metadata[field] = attrs['content'].strip()
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title.append(data)
+
+    def result(self):
+        if 'title' not in self.metadata and self._title:
+            self.metadata['title'] = ''.join(self._title).strip()
+
+        return self.metadata
+
+
+class MetadataFetcher(object):
+    """Fetch metadata for many urls concurrently."""
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, workers, timeout, host_interval, max_bytes,
+            allow_private_hosts=False):
+        self.timeout = timeout
+        self.host_interval = host_interval
+        self.max_bytes = max_bytes
+
+        self.session = requests.Session()
+        self.session.max_redirects = self.MAX_REDIRECTS
+        adapter = CheckedAdapter(allow_private_hosts,
+            pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pool = ThreadPool(workers)
+
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._host_last = {}
+
+    def _throttle(self, host):
+        """Block until a request to host is allowed."""
+
+        with self._lock:
+            lock = self._host_locks.setdefault(host, threading.Lock())
+
+        with lock:
+            wait = self._host_last.get(host, 0) + self.host_interval - time.time()
+
+            if wait > 0:
+                time.sleep(wait)
+
+            self._host_last[host] = time.time()
+
+    def fetch(self, url):
+        """Return a metadata dict for a url, empty if it couldn't be read."""
+
+        parsed = urlparse(url)
+
+        if parsed.scheme not in ('http', 'https'):
+            return {}
+
+        self._throttle(parsed.netloc)
+
+        try:
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+
+            try:
+                if response.status_code != 200 or \
+                        'html' not in response.headers.get('content-type', ''):
+                    return {}
+
+                html = response.raw.read(self.max_bytes, decode_content=True)
+            finally:
+                response.close()
+
+            try:
+                html = html.decode(response.encoding or 'utf-8', 'replace')
+            except LookupError:
+                # The page declared a charset Python doesn't know.
+                html = html.decode('utf-8', 'replace')
+
+            parser = MetadataParser()
+            parser.feed(html)
+
+            return parser.result()
+        except (requests.RequestException, HTMLParseError, IOError, ValueError):
+            return {}
+
+    def fetch_all(self, urls):
+        """Return a dict of url to metadata, fetching in parallel."""
+
+        urls = list(urls)
+
+        return dict(zip(urls, self.pool.map(self.fetch, urls)))
+
+
+def create_fetcher():
+    return MetadataFetcher(
+        workers=app.config['METADATA_WORKERS'],
+        timeout=app.config['METADATA_TIMEOUT'],
+        host_interval=app.config['METADATA_HOST_INTERVAL'],
+        max_bytes=app.config['METADATA_MAX_BYTES'],
+        allow_private_hosts=app.config['METADATA_ALLOW_PRIVATE_HOSTS'])
+
+
+def lookup(fetcher, urls):
+    """Return a dict of url to UrlMetadata, fetching expired or missing urls."""
+
+    if not urls:
+        return {}
+
+    cutoff = datetime.utcnow() - timedelta(days=app.config['METADATA_TTL_DAYS'])
+
+    cached = dict((row.url, row) for row in
+        UrlMetadata.query.filter(UrlMetadata.url.in_(urls)))
+
+    missing = [url for url in urls
+        if url not in cached or cached[url].date_fetched < cutoff]
+
+    for url, metadata in fetcher.fetch_all(missing).items():
+        row = cached.get(url) or UrlMetadata(url=url)
+        row.title = metadata.get('title', '')[:128] or None
+        row.author = metadata.get('author', '')[:64] or None
+        row.cover = metadata.get('cover', '')[:1024] or None
+
+        if row.cover and urlparse(row.cover).scheme not in ('http', 'https'):
+            row.cover = None
+
+        row.date_fetched = datetime.utcnow()
+
+        db.session.add(row)
+        cached[url] = row
+
+    db.session.commit()
+
+    return cached
+
+
+def enrich_books(fetcher, batch_size):
+    """Fill in the author and cover of every book not yet enriched.
+
+    Yields the number of books enriched per batch.
+
+    """
+
+    for key in sharding.all_shards():
+        with sharding.use_shard(key):
+            while True:
+                books = Book.query.filter(db.or_(
+                    Book.enriched == False,
+                    Book.enriched == None
+                )).limit(batch_size).all()
+
+                if not books:
+                    break
+
+                metadata = lookup(fetcher,
+                    list(set(book.url for book in books if book.url)))
+
+                users = set()
+
+                for book in books:
+                    row = metadata.get(book.url)
+
+                    if row is not None:
+                        if not book.author and row.author:
+                            book.author = row.author
+
+                        book.cover = row.cover
+                        book.user.log_change(book)
+                        users.add(book.user)
+
+                    book.enriched = True
+                    db.session.add(book)
+
+                for user in users:
+                    with sharding.for_user(user):
+                        user.update_dashboard()
+
+                db.session.commit()
+
+                yield len(books)
@@ -1,12 +1,17 @@
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from operator import itemgetter
+import heapq
+import json
 import re
 
 from flask import render_template, url_for
 
 from flask.ext.login import current_user
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 
-from . import db, util, bcrypt, app
+from . import db, util, bcrypt, app, sharding
 
 
 sets = db.Table('sets',
@@ -15,6 +20,33 @@ sets = db.Table('sets',
 )
 
 
+def get_or_insert(model, user_id):
+    """Return a model's row for a user, inserting an empty one if missing.
+
+    Two requests can both find the row missing. The insert runs in a
+    savepoint, so the one that loses the race rolls back only the savepoint
+    and reads the row the other inserted.
+
+    """
+
+    row = model.query.get(user_id)
+
+    if row is None:
+        # Flush first so rolling back the savepoint can't discard anything else.
+        db.session.flush()
+        db.session.begin_nested()
+
+        try:
+            row = model(user_id=user_id)
+            db.session.add(row)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            row = model.query.get(user_id)
+
+    return row
+
+
 class Set(db.Model):
 
     __tablename__ = 'set'
@@ -36,6 +68,9 @@ class Book(db.Model):
 
     __tablename__ = 'book'
 
+    __table_args__ = (
+        db.Index('ix_book_user_id_fingerprint', 'user_id', 'fingerprint'),)
+
     # Columns
 
     #-------------------------------------------------------------------------
@@ -48,9 +83,14 @@ class Book(db.Model):
 
     url = db.Column(db.String(1024))
 
+    cover = db.Column(db.String(1024))
+
+    # Whether the metadata for url has been looked up
+    enriched = db.Column(db.Boolean, default=False)
+
     date_added = db.Column(db.DateTime, default=datetime.utcnow)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='cascade'))
 
     reading = db.Column(db.Boolean, default=False)
 
@@ -58,14 +98,30 @@ class Book(db.Model):
 
     finished = db.Column(db.Boolean, default=False)
 
+    # util.fingerprint() of the title and author, to spot duplicates
+    fingerprint = db.Column(db.String(32))
+
     sets = db.relationship('Set', secondary=sets,
         backref=db.backref( 'books', lazy='dynamic'),
-        cascade='all')
+        cascade='save-update, merge',
+        passive_deletes=True)
+
+    @db.validates('title', 'author')
+    def _update_fingerprint(self, key, value):
+        title = value if key == 'title' else self.title
+        author = value if key == 'author' else self.author
+
+        self.fingerprint = util.fingerprint(title, author)
 
+        return value
 
     def update_sets(self, set_list):
 
-        for set in self.sets:
+        graph = SetGraph.for_user(current_user.id, lock=True)
+
+        old_set_ids = [set.id for set in self.sets]
+
+        for set in list(self.sets):
             self.sets.remove(set)
 
         db.session.flush()
@@ -80,14 +136,400 @@ class Book(db.Model):
             ).first()
 
             if existing_set and existing_set not in self.sets:
-                print existing_set.title
                 self.sets.append(existing_set)
             elif existing_set == None:
                 new_set = Set(title=set_title, user_id=current_user.id)
                 self.sets.append(new_set)
 
+        db.session.add(self)
+        db.session.flush()
+
+        graph.record(old_set_ids, self.sets)
+
         return
 
+
+class SetGraph(db.Model):
+    """Per-user counts of how often two sets share a book.
+
+    counts[a][b] is the number of books in both set a and set b, and
+    counts[a][a] the number of books in set a. Book.update_sets() keeps the
+    counts current, so suggesting sets never has to join the sets table.
+
+    """
+
+    __tablename__ = 'set_graph'
+
+    # Bump when the data layout changes so old rows are rebuilt.
+    VERSION = 1
+
+    # Columns
+
+    #-------------------------------------------------------------------------
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='cascade'),
+        primary_key=True)
+
+    version = db.Column(db.Integer)
+
+    data = db.Column(db.Text)
+
+    #-------------------------------------------------------------------------
+
+    @classmethod
+    def for_user(cls, user_id, lock=False):
+        """Return a user's graph, rebuilding it if missing or stale.
+
+        Pass lock when the graph will be changed: its row is then locked
+        until the transaction ends, so concurrent changes aren't lost.
+
+        """
+
+        graph = get_or_insert(cls, user_id)
+
+        if lock:
+            graph = cls.query.filter(cls.user_id == user_id).with_lockmode(
+                'update').populate_existing().one()
+
+        graph.rebuilt = graph.version != cls.VERSION
+
+        if graph.rebuilt:
+            graph.build()
+
+        return graph
+
+    def build(self):
+        """Recount from the sets table."""
+
+        rows = db.session.query(Set.id, Set.title, sets.c.book_id).join(
+            sets, sets.c.set_id == Set.id).filter(Set.user_id == self.user_id)
+
+        self.titles = {}
+        book_sets = defaultdict(list)
+
+        for set_id, title, book_id in rows:
+            self.titles[set_id] = title
+            book_sets[book_id].append(set_id)
+
+        self.counts = defaultdict(dict)
+
+        for set_ids in book_sets.values():
+            self._add(set_ids, 1)
+
+        self.save()
+
+    def _add(self, set_ids, n):
+        for a in set_ids:
+            for b in set_ids:
+                count = self.counts[a].get(b, 0) + n
+
+                if count > 0:
+                    self.counts[a][b] = count
+                else:
+                    self.counts[a].pop(b, None)
+
+    def _load(self):
+        # Parse again if data was reloaded since it was last parsed.
+        if getattr(self, '_parsed', None) != self.data:
+            data = json.loads(self.data)
+
+            self.titles = dict((int(id), title)
+                for id, title in data['titles'].items())
+
+            self.counts = defaultdict(dict, ((int(a), dict(
+                (int(b), n) for b, n in row.items()))
+                for a, row in data['counts'].items()))
+
+            self._parsed = self.data
+
+    def save(self):
+        self.version = self.VERSION
+        self.data = json.dumps({
+            'titles': self.titles,
+            'counts': dict((a, row) for a, row in self.counts.items() if row)
+        })
+        self._parsed = self.data
+
+        db.session.add(self)
+
+    def record(self, old_set_ids, new_sets):
+        """Move one book's memberships from old_set_ids to new_sets."""
+
+        self._load()
+
+        for set in new_sets:
+            self.titles[set.id] = set.title
+
+        self._add(old_set_ids, -1)
+        self._add([set.id for set in new_sets], 1)
+
+        self.save()
+
+    def suggest(self, set_ids, limit=5):
+        """Return the sets that most often share books with set_ids.
+
+        With no sets given, return the sets with the most books.
+
+        """
+
+        self._load()
+
+        scores = defaultdict(int)
+
+        if set_ids:
+            for a in set_ids:
+                for b, n in self.counts.get(a, {}).items():
+                    if b not in set_ids:
+                        scores[b] += n
+        else:
+            for a, row in self.counts.items():
+                if a in row:
+                    scores[a] = row[a]
+
+        return [{'id': set_id, 'title': self.titles[set_id]}
+            for set_id, score in heapq.nlargest(limit, scores.items(),
+                key=itemgetter(1))]
+
+    def suggest_for_titles(self, titles, limit=5):
+        """Like suggest(), for set titles as typed in the sets field."""
+
+        self._load()
+
+        ids = dict((title, set_id) for set_id, title in self.titles.items())
+
+        return self.suggest(
+            [ids[title] for title in titles if title in ids], limit)
+
+
+class SetRow(namedtuple('SetRow', 'id title')):
+    """A set's id and title, for listing pages."""
+
+    __slots__ = ()
+
+
+class BookRow(object):
+    """The columns a book card shows, without ORM instrumentation."""
+
+    __slots__ = ('id', 'title', 'author', 'url', 'cover', 'sets')
+
+    def __init__(self, id, title, author, url, cover):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.url = url
+        self.cover = cover
+        self.sets = []
+
+
+# Books whose sets book_rows() loads per query
+BOOK_ROWS_CHUNK = 500
+
+
+def book_rows(query):
+    """Return BookRows for the books a Book query matches.
+
+    Only the displayed columns are selected, and the sets of the books are
+    attached from one more query per BOOK_ROWS_CHUNK books, which keeps the
+    IN list under SQLite's limit on bound parameters.
+
+    """
+
+    rows = [BookRow(*columns) for columns in query.with_entities(
+        Book.id, Book.title, Book.author, Book.url, Book.cover)]
+
+    by_id = dict((row.id, row) for row in rows)
+    book_ids = list(by_id)
+
+    for start in range(0, len(book_ids), BOOK_ROWS_CHUNK):
+        memberships = db.session.query(Set.id, Set.title, sets.c.book_id).join(
+            sets, sets.c.set_id == Set.id
+        ).filter(sets.c.book_id.in_(
+            book_ids[start:start + BOOK_ROWS_CHUNK])).order_by(Set.id)
+
+        for set_id, title, book_id in memberships:
+            by_id[book_id].sets.append(SetRow(set_id, title))
+
+    return rows
+
+
+class UrlMetadata(db.Model):
+    """Cached page metadata for a url, shared by every book that links it."""
+
+    __tablename__ = 'url_metadata'
+
+    # Columns
+
+    #-------------------------------------------------------------------------
+
+    url = db.Column(db.String(1024), primary_key=True)
+
+    title = db.Column(db.String(128))
+
+    author = db.Column(db.String(64))
+
+    cover = db.Column(db.String(1024))
+
+    date_fetched = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class StripeCustomerDeletion(db.Model):
+    """A Stripe customer left to delete after its account was deleted."""
+
+    __tablename__ = 'stripe_customer_deletion'
+
+    # Columns
+
+    #-------------------------------------------------------------------------
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    stripe_id = db.Column(db.String(64))
+
+    attempts = db.Column(db.Integer, default=0)
+
+    last_error = db.Column(db.String(256))
+
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+
+    date_attempted = db.Column(db.DateTime)
+
+
+class Dashboard(db.Model):
+    """A denormalized snapshot of what a user's dashboard shows.
+
+    Rewritten by User.update_dashboard() whenever books or sets change so
+    the dashboard renders from a single primary key lookup.
+
+    """
+
+    __tablename__ = 'dashboard'
+
+    # Bump when the snapshot layout changes so old rows are rebuilt.
+    VERSION = 2
+
+    # Columns
+
+    #-------------------------------------------------------------------------
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='cascade'),
+        primary_key=True)
+
+    version = db.Column(db.Integer)
+
+    data = db.Column(db.Text)
+
+    date_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    #-------------------------------------------------------------------------
+
+    @staticmethod
+    def book_summary(book):
+        return {
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'url': book.url,
+            'cover': book.cover,
+            'sets': [{'id': set.id, 'title': set.title} for set in book.sets]
+        }
+
+    @classmethod
+    def build(cls, user):
+        """Compute the snapshot for a user from live queries."""
+
+        books = user.books
+
+        sets = Set.query.filter(
+            Set.user_id == user.id,
+            Set.books.any()
+        ).order_by(Set.id).limit(8)
+
+        return {
+            'books_exciting': [cls.book_summary(book)
+                for book in book_rows(books.filter_by(exciting=True))],
+            'books_reading': [cls.book_summary(book)
+                for book in book_rows(books.filter_by(reading=True))],
+            'books_recent': [cls.book_summary(book)
+                for book in book_rows(books.order_by(Book.date_added.desc()).limit(4))],
+            'sets': [{'id': set.id, 'title': set.title} for set in sets],
+            'book_count': user.books.count()
+        }
+
+
+class Change(db.Model):
+    """An entry in a user's append-only log of book changes.
+
+    The per-user seq doubles as the sync cursor. Entries only record which
+    book changed; clients are sent the book's current state.
+
+    """
+
+    __tablename__ = 'change'
+
+    __table_args__ = (
+        db.Index('ix_change_user_id_seq', 'user_id', 'seq', unique=True),)
+
+    # Columns
+
+    #-------------------------------------------------------------------------
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='cascade'))
+
+    # Allocated from User.changelog_seq
+    seq = db.Column(db.Integer)
+
+    # None for the marker written by User.reset_changelog()
+    book_id = db.Column(db.Integer)
+
+    deleted = db.Column(db.Boolean, default=False)
+
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+
+    #-------------------------------------------------------------------------
+
+    @classmethod
+    def compact(cls, retention):
+        """Bound the log to roughly one entry per book.
+
+        Entries superseded by a newer entry for the same book are dropped,
+        as are deletions older than the retention timedelta. Users whose
+        deletions are dropped get their changelog_floor raised so clients
+        holding an older cursor do a full resync.
+
+        """
+
+        newer = db.aliased(cls)
+
+        superseded = db.session.query(cls.id).filter(db.exists().where(db.and_(
+            newer.user_id == cls.user_id,
+            newer.book_id == cls.book_id,
+            newer.seq > cls.seq
+        ))).subquery()
+
+        cls.query.filter(cls.id.in_(superseded)).delete(
+            synchronize_session=False)
+
+        expired = db.session.query(cls.user_id, db.func.max(cls.seq)).filter(
+            cls.deleted == True,
+            cls.date_added < datetime.utcnow() - retention
+        ).group_by(cls.user_id)
+
+        for user_id, floor in expired.all():
+            User.query.filter(
+                User.id == user_id,
+                User.changelog_floor < floor
+            ).update({'changelog_floor': floor}, synchronize_session=False)
+
+        floor = db.select([User.changelog_floor]).where(
+            User.id == cls.user_id).as_scalar()
+
+        cls.query.filter(cls.seq < floor).delete(synchronize_session=False)
+
+        db.session.commit()
+
+
 class User(db.Model):
 
     __tablename__ = 'user'
@@ -114,7 +556,21 @@ class User(db.Model):
 
     account_expires = db.Column(db.DateTime, default=datetime.utcnow)
 
-    books = db.relationship('Book', backref='user', lazy='dynamic', cascade='all')
+    date_deleted = db.Column(db.DateTime, default=None)
+
+    shard = db.Column(db.String(32), default=None)
+
+    # The shard the user is being moved to by sharding.move_user()
+    shard_target = db.Column(db.String(32), default=None)
+
+    # Sync cursors below this must do a full resync
+    changelog_floor = db.Column(db.Integer, default=0)
+
+    # The seq of the user's latest change
+    changelog_seq = db.Column(db.Integer, default=0)
+
+    books = db.relationship('Book', backref='user', lazy='dynamic',
+        cascade='all', passive_deletes=True)
 
     #-------------------------------------------------------------------------
 
@@ -149,9 +605,10 @@ class User(db.Model):
 
         """ Automatically hash the password with Flask-Bcrypt """
 
-        self._password = bcrypt.generate_password_hash(
+        self._password = util.run_blocking(
+            bcrypt.generate_password_hash,
             password,
-            rounds=app.config['BCRYPT_LEVEL'])
+            app.config['BCRYPT_LEVEL'])
 
     def send_activation_email(self):
 
@@ -260,7 +717,7 @@ class User(db.Model):
 
         """ Check if a string matches this user's password """
 
-        if bcrypt.check_password_hash(self._password, pass_for_comp):
+        if util.run_blocking(bcrypt.check_password_hash, self._password, pass_for_comp):
             return True
 
         return False
@@ -270,24 +727,219 @@ class User(db.Model):
 
         """ Get a user object from an id or email"""
 
+        query = cls.query.filter(User.date_deleted == None)
+
         if userid:
-            user = cls.query.filter(User.id == userid).first()
+            user = query.filter(User.id == userid).first()
         elif email:
-            user = cls.query.filter(User.email == email).first()
+            user = query.filter(User.email == email).first()
 
         if user:
             return user
 
         return None
 
+    def update_dashboard(self):
+        """Rewrite the dashboard snapshot within the current transaction."""
+
+        db.session.flush()
+
+        data = Dashboard.build(self)
+
+        dashboard = get_or_insert(Dashboard, self.id)
+        dashboard.version = Dashboard.VERSION
+        dashboard.data = json.dumps(data)
+        dashboard.date_updated = datetime.utcnow()
+
+        db.session.add(dashboard)
+
+        return data
+
+    def get_dashboard(self):
+        """Return the dashboard snapshot, rebuilding it if missing or stale."""
+
+        dashboard = Dashboard.query.get(self.id)
+
+        if dashboard and dashboard.version == Dashboard.VERSION:
+            return json.loads(dashboard.data)
+
+        data = self.update_dashboard()
+        db.session.commit()
+
+        return data
+
+    def get_set_graph(self):
+        """Return the set graph, saving it if it had to be rebuilt."""
+
+        graph = SetGraph.for_user(self.id)
+
+        if graph.rebuilt:
+            db.session.commit()
+
+        return graph
+
+    def log_change(self, book, deleted=False):
+        """Append a change for a book to this user's change log."""
+
+        db.session.flush()
+
+        self.log_changes([(book.id, deleted)])
+
+    def log_changes(self, changes):
+        """Append (book id, deleted) pairs to this user's change log.
+
+        Sequence numbers are taken by bumping changelog_seq, which holds the
+        lock on the user's row until the transaction ends. Changes therefore
+        commit in sequence order, and a client can't sync past one that is
+        still to commit. Returns the last sequence number.
+
+        """
+
+        users = User.query.filter(User.id == self.id)
+
+        users.update({'changelog_seq': User.changelog_seq + len(changes)},
+            synchronize_session=False)
+
+        last = users.with_entities(User.changelog_seq).scalar()
+        db.session.expire(self, ['changelog_seq'])
+
+        for seq, (book_id, deleted) in enumerate(changes, last - len(changes) + 1):
+            db.session.add(Change(user_id=self.id, seq=seq, book_id=book_id,
+                deleted=deleted))
+
+        return last
+
+    def reset_changelog(self):
+        """Make every existing sync cursor do a full resync."""
+
+        self.changelog_floor = self.log_changes([(None, False)])
+        db.session.add(self)
+
+    @staticmethod
+    def book_state(book):
+        return {
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'url': book.url,
+            'cover': book.cover,
+            'reading': book.reading,
+            'exciting': book.exciting,
+            'finished': book.finished,
+            'sets': [set.title for set in book.sets]
+        }
+
+    def changes_since(self, cursor, limit, after=0):
+        """Return the books changed or deleted after a sync cursor.
+
+        At most limit log entries are read; `more` tells the client to ask
+        again with the returned cursor.
+
+        A cursor below changelog_floor gets a full resync instead, a page of
+        at most limit books with ids above after. The client asks for the
+        next page with the same cursor and the returned `after`, and carries
+        on from the cursor returned with the first page.
+
+        """
+
+        books = self.books.options(db.joinedload(Book.sets))
+
+        if cursor < (self.changelog_floor or 0):
+            page = books.filter(Book.id > after).order_by(Book.id).limit(
+                limit).all()
+
+            return {
+                'reset': True,
+                'cursor': self.changelog_seq or 0,
+                'after': page[-1].id if page else after,
+                'more': len(page) == limit,
+                'books': [self.book_state(book) for book in page],
+                'deleted': []
+            }
+
+        changes = Change.query.filter(
+            Change.user_id == self.id,
+            Change.seq > cursor
+        ).order_by(Change.seq).limit(limit).all()
+
+        latest = {}
+
+        for change in changes:
+            if change.book_id is not None:
+                latest[change.book_id] = change
+
+        changed = [book_id for book_id, change in latest.items()
+            if not change.deleted]
+
+        if changed:
+            changed = books.filter(Book.id.in_(changed)).all()
+
+        return {
+            'reset': False,
+            'cursor': changes[-1].seq if changes else cursor,
+            'more': len(changes) == limit,
+            'books': [self.book_state(book) for book in changed],
+            'deleted': [book_id for book_id, change in latest.items()
+                if change.deleted]
+        }
+
     def get_sets(self):
-        """Return a list of set objects"""
+        """Return a list of the sets that have books in them"""
+
+        return Set.query.filter(
+            Set.user_id == self.id,
+            Set.books.any()
+        ).order_by(Set.id).all()
+
+    def delete(self):
+        """Delete the account.
 
-        sets = []
+        Books, sets and set memberships are removed by the database's
+        foreign key cascades. Accounts with more books than
+        ACCOUNT_PURGE_THRESHOLD, or whose books live on a shard the user
+        row's cascades cannot reach, are only tombstoned here and left for
+        purge_deleted() to remove in the background.
 
-        for book in self.books:
-            for set in book.sets:
-                if set not in sets:
-                    sets.append(set)
+        The Stripe customer is queued for deletion by
+        payments.process_customer_deletions().
+
+        """
+
+        if self.stripe_id:
+            db.session.add(StripeCustomerDeletion(stripe_id=self.stripe_id))
+            self.stripe_id = None
+
+        if self.shard is not None or \
+                self.books.count() > app.config['ACCOUNT_PURGE_THRESHOLD']:
+            self.active = False
+            self.email = None
+            self.date_deleted = datetime.utcnow()
+            db.session.add(self)
+        else:
+            db.session.delete(self)
+
+    def purge(self, chunk_size):
+        """Delete this user's books and sets chunk by chunk, then the user."""
+
+        with sharding.for_user(self):
+            for model in (Book, Set):
+                while True:
+                    ids = [row.id for row in db.session.query(model.id).filter(
+                        model.user_id == self.id).limit(chunk_size)]
+
+                    if not ids:
+                        break
+
+                    model.query.filter(model.id.in_(ids)).delete(
+                        synchronize_session=False)
+                    db.session.commit()
+
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def purge_deleted(cls, chunk_size):
+        """Purge every tombstoned account."""
 
-        return sets
+        for user in cls.query.filter(cls.date_deleted != None).all():
+            user.purge(chunk_size)
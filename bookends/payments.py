@@ -0,0 +1,104 @@
+"""A small client for the parts of the Stripe API that run outside billing
+pages.
+
+Requests share one keep-alive connection pool, time out after
+STRIPE_TIMEOUT seconds and are retried with exponential backoff on
+connection errors, 429s and 5xx responses. Only idempotent requests go
+through here, so retrying is safe.
+
+"""
+from datetime import datetime
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import app, db
+
+
+class StripeError(Exception):
+    pass
+
+
+class StripeGateway(object):
+
+    def __init__(self, api_key, api_base, timeout, retries, backoff, pool_size):
+        self.api_base = api_base.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.auth = (api_key, '')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, data=None):
+        """Make a request and return the response, retrying failures."""
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                response = self.session.request(method, self.api_base + path,
+                    data=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = StripeError(str(e))
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                error = StripeError('%s %s returned %s' % (
+                    method, path, response.status_code))
+                continue
+
+            return response
+
+        raise error
+
+    def delete_customer(self, customer_id):
+        """Delete a customer, treating one that's already gone as deleted."""
+
+        response = self.request('DELETE', '/v1/customers/' + customer_id)
+
+        if response.status_code not in (200, 404):
+            raise StripeError('Deleting %s returned %s' % (
+                customer_id, response.status_code))
+
+
+gateway = StripeGateway(
+    api_key=app.config['STRIPE_API_KEY'],
+    api_base=app.config['STRIPE_API_BASE'],
+    timeout=app.config['STRIPE_TIMEOUT'],
+    retries=app.config['STRIPE_RETRIES'],
+    backoff=app.config['STRIPE_RETRY_BACKOFF'],
+    pool_size=app.config['STRIPE_POOL_SIZE'])
+
+
+def process_customer_deletions():
+    """Delete the Stripe customers of deleted accounts.
+
+    Yields (deletion, error or None) for each pending deletion.
+
+    """
+
+    from .models import StripeCustomerDeletion
+
+    for deletion in StripeCustomerDeletion.query.order_by(
+            StripeCustomerDeletion.id).all():
+        try:
+            gateway.delete_customer(deletion.stripe_id)
+        except StripeError as e:
+            deletion.attempts += 1
+            deletion.last_error = str(e)[:256]
+            deletion.date_attempted = datetime.utcnow()
+            db.session.add(deletion)
+            db.session.commit()
+
+            yield deletion, e
+        else:
+            db.session.delete(deletion)
+            db.session.commit()
+
+            yield deletion, None
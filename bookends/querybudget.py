@@ -0,0 +1,244 @@
+"""Count the SQL statements every route emits against seeded fixtures.
+
+Each route in views.py declares an expected status and a statement budget
+below. run() seeds a scratch SQLite database at each of several library
+sizes, requests every route through the test client as a signed in user
+and counts statements with an engine event. A route fails if it answers
+with another status, if it goes over budget, or if it emits more
+statements for a larger library, which means something is loading rows
+one query at a time.
+
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import os
+import tempfile
+
+from sqlalchemy import event
+
+from . import app, db, util
+from .models import User, Book, Set
+
+
+Route = namedtuple('Route', 'endpoint method url data status budget')
+
+# url and data are called with the seeded fixtures.
+ROUTES = [
+    Route('index', 'GET', lambda f: '/', None, 200, 4),
+    Route('about', 'GET', lambda f: '/about', None, 200, 2),
+    Route('create_account', 'GET', lambda f: '/accounts/create', None, 200, 2),
+    Route('activate_account', 'GET',
+        lambda f: '/accounts/activate/' + util.ts.dumps(
+            f['email'], salt='activation-key'), None, 302, 5),
+    Route('recover_account', 'GET', lambda f: '/accounts/recover', None,
+        200, 2),
+    Route('recover_account_with_token', 'GET',
+        lambda f: '/accounts/recover/' + util.ts.dumps(
+            f['email'], salt='recover-key'), None, 200, 2),
+    Route('signin', 'GET', lambda f: '/signin', None, 200, 2),
+    Route('books', 'GET', lambda f: '/books', None, 200, 4),
+    Route('add_book', 'GET', lambda f: '/books/add', None, 200, 6),
+    Route('add_book', 'POST', lambda f: '/books/add',
+        lambda f: {'title': 'Added', 'author': 'Author',
+                   'sets': '{%s} {%s}' % tuple(f['set_titles'][:2])},
+        302, 26),
+    Route('edit_book', 'GET',
+        lambda f: '/books/edit/%d' % f['book_ids'][0], None, 200, 6),
+    Route('edit_book', 'POST',
+        lambda f: '/books/edit/%d' % f['book_ids'][0],
+        lambda f: {'title': 'Edited', 'author': 'Author', 'reading': 'y',
+                   'sets': '{%s} {%s}' % tuple(f['set_titles'][:2])},
+        302, 27),
+    Route('delete_book', 'POST',
+        lambda f: '/books/delete/%d' % f['book_ids'][1], lambda f: {},
+        302, 23),
+    Route('sets', 'GET', lambda f: '/sets', None, 200, 4),
+    Route('view_set', 'GET',
+        lambda f: '/sets/view/%d' % f['set_ids'][0], None, 200, 5),
+    Route('api_sync', 'GET', lambda f: '/api/sync?since=0', None, 200, 5),
+    Route('api_suggest_sets', 'GET',
+        lambda f: '/api/sets/suggest?sets={%s}' % f['set_titles'][0], None,
+        200, 3),
+    Route('refresh_login', 'GET', lambda f: '/accounts/refresh', None, 200, 3),
+    Route('account_password', 'GET', lambda f: '/accounts/password', None,
+        200, 3),
+    Route('account_email', 'GET', lambda f: '/accounts/email', None, 200, 3),
+    Route('account_email_update', 'GET',
+        lambda f: '/accounts/email/update/' + util.ts.dumps(
+            f['email'], salt='email-update-key'), None, 302, 5),
+    Route('account_delete', 'GET', lambda f: '/accounts/delete', None, 200, 3),
+    Route('signout', 'GET', lambda f: '/signout', None, 302, 2),
+]
+
+# Routes that can't be exercised against local fixtures.
+SKIPPED = {
+    'stripe_webhook': 'needs an event posted by Stripe',
+    'static': 'serves files',
+    'soak_slow': 'waits on an upstream server',
+}
+
+
+@contextmanager
+def scratch_database(shards=()):
+    """Point the app at temporary SQLite databases inside the block: a main
+    one and one for each of the named book storage shards."""
+
+    paths = []
+
+    def scratch_uri():
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        paths.append(path)
+
+        return 'sqlite:///' + path
+
+    overrides = dict(
+        SQLALCHEMY_DATABASE_URI=scratch_uri(),
+        SQLALCHEMY_BINDS=dict((key, scratch_uri()) for key in shards),
+        BOOK_SHARDS=list(shards),
+        BCRYPT_LEVEL=4,
+        CSRF_ENABLED=False,
+        WTF_CSRF_ENABLED=False)
+
+    missing = object()
+    saved = dict((key, app.config.get(key, missing)) for key in overrides)
+
+    app.config.update(overrides)
+
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is missing:
+                app.config.pop(key, None)
+            else:
+                app.config[key] = value
+
+        for path in paths:
+            os.remove(path)
+
+
+class StatementCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def seed(size):
+    """Create a user with a library of size books and return the fixtures."""
+
+    db.drop_all()
+    db.create_all()
+
+    user = User(email='reader@example.com', password='password',
+        email_confirmed=True)
+    db.session.add(user)
+    db.session.flush()
+
+    sets = [Set(title='Set %d' % i, user_id=user.id)
+        for i in range(max(2, size // 5))]
+
+    books = []
+
+    for i in range(size):
+        book = Book(title='Book %d' % i, author='Author %d' % i,
+            url='http://example.com/%d' % i, enriched=True,
+            exciting=i % 3 == 0, reading=i % 4 == 0)
+        book.sets = [sets[i % len(sets)], sets[(i + 1) % len(sets)]]
+        user.books.append(book)
+        books.append(book)
+
+    db.session.add(user)
+
+    for book in books:
+        user.log_change(book)
+
+    user.update_dashboard()
+    db.session.commit()
+
+    return {
+        'user_id': user.id,
+        'email': user.email,
+        'book_ids': [book.id for book in books],
+        'set_ids': [set.id for set in sets],
+        'set_titles': [set.title for set in sets]
+    }
+
+
+def measure(counter, fixtures):
+    """Return a dict of (endpoint, method) to (status, statement count)."""
+
+    counts = {}
+
+    for route in ROUTES:
+        client = app.test_client()
+
+        with client.session_transaction() as session:
+            session['user_id'] = fixtures['user_id']
+            session['_fresh'] = True
+
+        url = route.url(fixtures)
+        data = route.data(fixtures) if route.data else None
+
+        # Warm GETs up first so one-off work such as rebuilding the
+        # dashboard snapshot isn't counted.
+        if route.method == 'GET':
+            client.get(url)
+
+        counter.count = 0
+        response = client.open(url, method=route.method, data=data)
+        counts[route.endpoint, route.method] = (
+            response.status_code, counter.count)
+
+    return counts
+
+
+def run(sizes=(5, 50)):
+    """Measure every route at each library size, smallest first.
+
+    Returns a list of (route, counts by size, failure or None).
+
+    """
+
+    missing = set(rule.endpoint for rule in app.url_map.iter_rules()) - \
+        set(route.endpoint for route in ROUTES) - set(SKIPPED)
+
+    if missing:
+        raise RuntimeError('Routes without a query budget: ' +
+            ', '.join(sorted(missing)))
+
+    with scratch_database():
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+        counts = {}
+
+        for size in sizes:
+            with app.app_context():
+                fixtures = seed(size)
+
+            counts[size] = measure(counter, fixtures)
+
+    results = []
+
+    for route in ROUTES:
+        key = route.endpoint, route.method
+        statuses = [counts[size][key][0] for size in sizes]
+        by_size = [counts[size][key][1] for size in sizes]
+        failure = None
+
+        wrong = [status for status in statuses if status != route.status]
+
+        if wrong:
+            failure = 'answered %d instead of %d' % (wrong[0], route.status)
+        elif max(by_size) > route.budget:
+            failure = 'over its budget of %d' % route.budget
+        elif by_size[-1] > by_size[0]:
+            failure = 'grows with library size'
+
+        results.append((route, by_size, failure))
+
+    return results
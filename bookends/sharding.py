@@ -0,0 +1,458 @@
+"""Route book storage to per-user shards.
+
+The book, set and sets tables can be spread over several databases, listed
+by their SQLALCHEMY_BINDS key in BOOK_SHARDS. All of a user's rows live on
+one shard, recorded in User.shard, so every query against those tables is
+sent to the shard of the user it belongs to: the signed in user during a
+request, or the user given to for_user() in background jobs.
+
+Users whose shard is None keep their books in the main database, which is
+where everything lives when BOOK_SHARDS is empty.
+
+"""
+from contextlib import contextmanager
+import json
+import threading
+
+from flask import has_request_context
+from flask.ext.login import current_user
+from sqlalchemy import select
+from sqlalchemy.sql.util import find_tables
+
+from . import app, db
+
+
+SHARDED_TABLES = ('book', 'set', 'sets')
+
+_unset = object()
+
+_local = threading.local()
+
+
+def shard_for_user_id(user_id):
+    """Return the shard a user belongs on: hash partitioning by id."""
+
+    keys = app.config['BOOK_SHARDS']
+
+    if not keys:
+        return None
+
+    return keys[user_id % len(keys)]
+
+
+def all_shards():
+    """Return every place book storage can live, the main database first."""
+
+    return [None] + list(app.config['BOOK_SHARDS'])
+
+
+@contextmanager
+def use_shard(key):
+    """Send book storage queries to the given shard inside the block."""
+
+    previous = getattr(_local, 'shard', _unset)
+    _local.shard = key
+
+    try:
+        yield
+    finally:
+        _local.shard = previous
+
+
+def for_user(user):
+    """Send book storage queries to the given user's shard inside the block."""
+
+    return use_shard(user.shard)
+
+
+def current_shard():
+    """Return the shard book storage queries are currently routed to."""
+
+    key = getattr(_local, 'shard', _unset)
+
+    if key is not _unset:
+        return key
+
+    if has_request_context() and current_user.is_authenticated():
+        return current_user.shard
+
+    return None
+
+
+def get_engine(key):
+    """Return the engine for a shard, or the main engine for None."""
+
+    return db.get_engine(app, bind=key)
+
+
+def is_sharded(mapper, clause):
+    """Return whether a statement reads or writes the sharded tables.
+
+    Queries for columns rather than entities, such as with_entities() and
+    count(), come without a mapper, so the statement itself is searched.
+
+    """
+
+    if mapper is not None:
+        return mapper.mapped_table.name in SHARDED_TABLES
+
+    if clause is not None:
+        return any(table.name in SHARDED_TABLES
+            for table in find_tables(clause, include_crud=True))
+
+    return False
+
+
+def install(db):
+    """Make db.session route the sharded tables through current_shard()."""
+
+    factory = db.session.session_factory
+
+    class ShardedSession(factory.func):
+
+        def get_bind(self, mapper, clause=None):
+            if is_sharded(mapper, clause):
+                key = current_shard()
+
+                if key is not None:
+                    return get_engine(key)
+
+            return super(ShardedSession, self).get_bind(mapper, clause)
+
+    db.session.session_factory = db.session.registry.createfunc = \
+        lambda **kwargs: ShardedSession(*factory.args,
+            **dict(factory.keywords or {}, **kwargs))
+
+
+def tables():
+    return [db.metadata.tables[name] for name in SHARDED_TABLES]
+
+
+def shard_metadata():
+    """Return copies of the sharded tables for creating them on a shard.
+
+    The copies keep the foreign keys between the sharded tables but drop
+    the ones to the user table, which only exists in the main database.
+
+    """
+
+    metadata = db.MetaData()
+
+    for table in tables():
+        columns = [db.Column(column.name, column.type,
+            *[db.ForeignKey(fk.target_fullname, ondelete=fk.ondelete)
+                for fk in column.foreign_keys
+                if fk.target_fullname.split('.')[0] in SHARDED_TABLES],
+            primary_key=column.primary_key, nullable=column.nullable)
+            for column in table.columns]
+
+        copy = db.Table(table.name, metadata, *columns)
+
+        for index in table.indexes:
+            db.Index(index.name, *[copy.c[column.name] for column in index.columns])
+
+    return metadata
+
+
+def create_shards():
+    """Create the book storage tables on every shard."""
+
+    metadata = shard_metadata()
+
+    for key in app.config['BOOK_SHARDS']:
+        metadata.create_all(bind=get_engine(key))
+
+
+def _delete_user_rows(connection, user_id):
+    book, set, sets = tables()
+
+    connection.execute(sets.delete().where(sets.c.book_id.in_(
+        select([book.c.id]).where(book.c.user_id == user_id))))
+    connection.execute(book.delete().where(book.c.user_id == user_id))
+    connection.execute(set.delete().where(set.c.user_id == user_id))
+
+
+def move_user(user, target):
+    """Copy a user's books, sets and memberships to another shard.
+
+    User.shard_target is set for the length of the move, and lock_library
+    refuses book and set writes while it is. Setting it takes the lock on
+    the user's row that those writes hold, so writes already in flight
+    finish before the copy starts.
+
+    Rows are copied in id order, so their new ids on the target shard keep
+    the order of the old ones. The user's sync clients are made to do a
+    full resync, and the dashboard snapshot and set graph are rebuilt. A
+    move interrupted before User.shard is switched is redone by the next
+    rebalance(); rows left behind on the source shard are removed by
+    sweep().
+
+    """
+
+    from .models import User, Dashboard, SetGraph
+
+    book, set, sets = tables()
+
+    User.query.filter(User.id == user.id).with_lockmode('update').populate_existing().one()
+    user.shard_target = target
+    db.session.add(user)
+    db.session.commit()
+
+    source = get_engine(user.shard).connect()
+    destination = get_engine(target).connect()
+
+    try:
+        transaction = destination.begin()
+
+        _delete_user_rows(destination, user.id)
+
+        new_ids = {}
+
+        for table in (set, book):
+            new_ids[table.name] = {}
+
+            for row in source.execute(
+                    table.select().where(table.c.user_id == user.id)
+                        .order_by(table.c.id)):
+                values = dict(row)
+                old_id = values.pop('id')
+                new_ids[table.name][old_id] = destination.execute(
+                    table.insert(), values).inserted_primary_key[0]
+
+        memberships = [
+            {'set_id': new_ids['set'][row.set_id],
+             'book_id': new_ids['book'][row.book_id]}
+            for row in source.execute(select([sets]).select_from(
+                sets.join(book)).where(book.c.user_id == user.id))]
+
+        if memberships:
+            destination.execute(sets.insert(), memberships)
+
+        transaction.commit()
+
+        user.shard = target
+        user.shard_target = None
+        user.reset_changelog()
+        Dashboard.query.filter_by(user_id=user.id).delete()
+        SetGraph.query.filter_by(user_id=user.id).delete()
+        db.session.add(user)
+        db.session.commit()
+
+        transaction = source.begin()
+        _delete_user_rows(source, user.id)
+        transaction.commit()
+    finally:
+        source.close()
+        destination.close()
+
+
+def rebalance():
+    """Move every user whose shard no longer matches BOOK_SHARDS, and
+    finish interrupted moves.
+
+    Yields (user, source, target) for each user moved. Only one rebalance
+    should run at a time, and it should be followed by sweep().
+
+    """
+
+    from .models import User
+
+    users = User.query.filter(User.date_deleted == None).order_by(User.id)
+
+    for user in users.all():
+        target = shard_for_user_id(user.id)
+
+        if user.shard != target or user.shard_target is not None:
+            source = user.shard
+            move_user(user, target)
+            yield user, source, target
+
+
+def sweep():
+    """Delete rows kept on a shard that doesn't own them.
+
+    They are left by moves interrupted after the switch to the new shard,
+    or on an abandoned target. Rows of users on their way to a shard are
+    kept. Returns the number of users whose rows were removed.
+
+    """
+
+    from .models import User
+
+    owners = dict((row.id, (row.shard, row.shard_target)) for row in
+        db.session.query(User.id, User.shard, User.shard_target))
+
+    # Users created while sweeping aren't in owners but own their rows.
+    newest = max(owners) if owners else 0
+
+    book_table, set_table, sets_table = tables()
+
+    removed = 0
+
+    for key in all_shards():
+        connection = get_engine(key).connect()
+
+        try:
+            user_ids = set()
+
+            for table in (book_table, set_table):
+                user_ids.update(row.user_id for row in connection.execute(
+                    select([table.c.user_id]).distinct()))
+
+            for user_id in user_ids:
+                if user_id is None or user_id > newest or \
+                        key in owners.get(user_id, ()):
+                    continue
+
+                transaction = connection.begin()
+                _delete_user_rows(connection, user_id)
+                transaction.commit()
+
+                removed += 1
+        finally:
+            connection.close()
+
+    return removed
+
+
+def _signed_in_client(user_id):
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['_fresh'] = True
+
+    return client
+
+
+def _check_libraries(libraries, when):
+    """Return what went wrong when each user views their library."""
+
+    from .models import Dashboard
+
+    problems = []
+
+    for user_id, (titles, set_id) in sorted(libraries.items()):
+        others = [title for other, (other_titles, _) in libraries.items()
+            if other != user_id for title in other_titles]
+
+        client = _signed_in_client(user_id)
+
+        for url in ('/books', '/sets/view/%d' % set_id):
+            page = client.get(url).data
+
+            if any(title not in page for title in titles) or \
+                    any(title in page for title in others):
+                problems.append('%s: %s shows the wrong books to user %d' % (
+                    when, url, user_id))
+
+        if 'placeholder="title"' not in client.get('/books/add').data:
+            problems.append('%s: /books/add counts no books for user %d' % (
+                when, user_id))
+
+        client.get('/')
+
+        with app.app_context():
+            count = json.loads(Dashboard.query.get(user_id).data)['book_count']
+
+        if count != len(titles):
+            problems.append('%s: the dashboard of user %d counts %d books' % (
+                when, user_id, count))
+
+        if not json.loads(client.get('/api/sets/suggest').data)['sets']:
+            problems.append('%s: no sets suggested to user %d' % (
+                when, user_id))
+
+    return problems
+
+
+def _purge(user_id):
+    """Delete and purge a user, and return the rows left behind."""
+
+    from .models import User, Book, Set
+
+    with app.app_context():
+        User.query.get(user_id).delete()
+        db.session.commit()
+
+        User.purge_deleted(app.config['PURGE_CHUNK_SIZE'])
+
+        left = 0
+
+        for key in all_shards():
+            with use_shard(key):
+                left += Book.query.filter_by(user_id=user_id).count() + \
+                    Set.query.filter_by(user_id=user_id).count()
+
+        return left
+
+
+def check():
+    """Run the views for users spread over two SQLite shards.
+
+    Every user should see exactly their own books, before and after a
+    rebalance onto one shard, and purging a user should leave no rows on
+    any shard. Returns a list of what went wrong, empty if nothing did.
+
+    """
+
+    from .models import User, Book, Set
+    from .querybudget import scratch_database
+
+    problems = []
+
+    with scratch_database(shards=['books_0', 'books_1']):
+        libraries = {}
+
+        with app.app_context():
+            db.create_all()
+            create_shards()
+
+            for n in range(3):
+                user = User(email='reader%d@example.com' % n,
+                    password='password', email_confirmed=True)
+                db.session.add(user)
+                db.session.flush()
+
+                user.shard = shard_for_user_id(user.id)
+                db.session.commit()
+
+                with for_user(user):
+                    shelf = Set(title='Shelf %d' % n, user_id=user.id)
+                    titles = ['Book %d.%d' % (n, i) for i in range(3)]
+
+                    for title in titles:
+                        book = Book(title=title, author='Author',
+                            enriched=True, exciting=True)
+                        book.sets = [shelf]
+                        user.books.append(book)
+
+                    db.session.add(user)
+                    db.session.commit()
+
+                    libraries[user.id] = titles, shelf.id
+
+        problems += _check_libraries(libraries, 'sharded')
+
+        app.config['BOOK_SHARDS'] = ['books_0']
+
+        with app.app_context():
+            for moved in rebalance():
+                pass
+
+            sweep()
+
+            for user_id in libraries:
+                with for_user(User.query.get(user_id)):
+                    set_id = Set.query.filter_by(user_id=user_id).one().id
+                    libraries[user_id] = libraries[user_id][0], set_id
+
+        problems += _check_libraries(libraries, 'rebalanced')
+
+        user_id = min(libraries)
+        left = _purge(user_id)
+
+        if left:
+            problems.append('purging user %d left %d rows' % (user_id, left))
+
+    return problems
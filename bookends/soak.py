@@ -0,0 +1,158 @@
+"""Load the app with concurrent connections to compare the worker modes.
+
+check() serves a slow view, one that waits on an upstream server the way
+the Mandrill and Stripe calls do, with gunicorn's sync workers and then
+with gunicorn_gevent.py, and fails unless the gevent workers keep serving
+more requests per second as connections outnumber the workers.
+
+"""
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import app
+
+
+WORKERS = 2
+
+
+@app.route('/soak/slow')
+def soak_slow():
+    """Wait on the upstream server named by BOOKENDS_SOAK_UPSTREAM."""
+
+    requests.get(os.environ['BOOKENDS_SOAK_UPSTREAM'], timeout=30)
+
+    return 'ok'
+
+
+def measure(url, connections, total):
+    """Request url total times over a number of concurrent connections and
+    return the requests per second and the number of failed requests."""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def get(i):
+        try:
+            return session.get(url, timeout=60).status_code
+        except requests.RequestException:
+            return None
+
+    pool = ThreadPool(connections)
+
+    start = time.time()
+    statuses = pool.map(get, range(total))
+    elapsed = time.time() - start
+
+    pool.close()
+
+    return total / elapsed, len([status for status in statuses if status != 200])
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def start_gunicorn(options, upstream):
+    """Start gunicorn serving the app with options and return the process
+    and the URL of the slow view, once it answers."""
+
+    root = os.path.dirname(app.root_path)
+    port = free_port()
+
+    process = subprocess.Popen([sys.executable, '-c',
+            'from gunicorn.app.wsgiapp import run; run()'] + options +
+            ['-b', '127.0.0.1:%d' % port, 'bookends.soak:app'],
+        cwd=root, env=dict(os.environ, BOOKENDS_SOAK_UPSTREAM=upstream))
+
+    url = 'http://127.0.0.1:%d/soak/slow' % port
+    deadline = time.time() + 30
+
+    while True:
+        try:
+            requests.get(url, timeout=5)
+            return process, url
+        except requests.RequestException:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('gunicorn %s did not start' % ' '.join(options))
+
+            time.sleep(0.2)
+
+
+def check(connections=20, total=40, delay=0.25, scale=3):
+    """Compare the worker modes and return a list of what went wrong, empty
+    if requests succeed and the gevent workers serve at least scale times
+    the requests per second of the sync ones over connections, and of
+    their own over as many connections as there are workers.
+
+    """
+
+    from . import fakepages
+
+    upstream = fakepages.create_server(0, delay)
+
+    thread = threading.Thread(target=upstream.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    upstream_url = 'http://localhost:%d/slow' % upstream.server_port
+    root = os.path.dirname(app.root_path)
+
+    modes = [
+        ('sync', ['-w', str(WORKERS)]),
+        ('gevent', ['-c', os.path.join(root, 'gunicorn_gevent.py'),
+            '-w', str(WORKERS)]),
+    ]
+
+    problems = []
+    rates = {}
+
+    try:
+        for mode, options in modes:
+            process, url = start_gunicorn(options, upstream_url)
+
+            try:
+                for n in (WORKERS, connections):
+                    rate, errors = measure(url, n, total)
+                    rates[mode, n] = rate
+
+                    print '%s, %d connections: %.1f req/s, %d errors' % (
+                        mode, n, rate, errors)
+
+                    if errors:
+                        problems.append('%s workers failed %d of %d requests '
+                            'over %d connections' % (mode, errors, total, n))
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        upstream.shutdown()
+
+    if rates['gevent', connections] < scale * rates['sync', connections]:
+        problems.append('gevent served %.1f req/s over %d connections, less '
+            'than %d times the %.1f of sync workers' % (
+                rates['gevent', connections], connections, scale,
+                rates['sync', connections]))
+
+    if rates['gevent', connections] < scale * rates['gevent', WORKERS]:
+        problems.append('gevent served %.1f req/s over %d connections, less '
+            'than %d times its %.1f over %d' % (
+                rates['gevent', connections], connections, scale,
+                rates['gevent', WORKERS], WORKERS))
+
+    return problems
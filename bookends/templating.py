@@ -0,0 +1,140 @@
+"""Template compilation caching and benchmarks.
+
+Compiled templates are kept in a Jinja bytecode cache on disk, so a new
+worker only has to unmarshal them instead of parsing and compiling every
+template on its first requests. `manage.py compile_templates` fills the
+cache at deploy time. Cache files are written under a temporary name and
+renamed into place, so a worker never reads one that is half written.
+
+"""
+import errno
+from fnmatch import fnmatch
+import os
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+from . import app
+
+
+def cache_dir():
+    return app.config['JINJA_CACHE_DIR'] or \
+        os.path.join(app.instance_path, 'jinja_cache')
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """A FileSystemBytecodeCache that replaces files atomically and creates
+    its directory on the first write."""
+
+    def dump_bytecode(self, bucket):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                bucket.write_bytecode(f)
+
+            os.rename(temp, self._get_cache_filename(bucket))
+        except:
+            os.remove(temp)
+            raise
+
+
+def install_bytecode_cache():
+    """Give the app's Jinja environment a filesystem bytecode cache.
+
+    Must run before the first template is rendered, since Flask creates the
+    environment from jinja_options on first use.
+
+    """
+
+    app.jinja_options = dict(app.jinja_options,
+        bytecode_cache=AtomicBytecodeCache(cache_dir()))
+
+
+def load_templates(env):
+    """Load every template into env and return the seconds it took."""
+
+    start = time.time()
+
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
+
+    return time.time() - start
+
+
+def compile_templates():
+    """Compile every template into the bytecode cache, replacing what's
+    there while workers may be reading it, remove the files of templates
+    that no longer exist and return the seconds it took."""
+
+    start = time.time()
+
+    env = app.create_jinja_environment()
+    cache = env.bytecode_cache
+
+    written = set()
+
+    for name in env.list_templates(extensions=['html']):
+        source, filename, uptodate = env.loader.get_source(env, name)
+
+        bucket = cache.get_bucket(env, name, filename, source)
+        bucket.code = env.compile(source, name, filename)
+        cache.set_bucket(bucket)
+
+        written.add(os.path.basename(cache._get_cache_filename(bucket)))
+
+    for filename in os.listdir(cache.directory):
+        if fnmatch(filename, cache.pattern % '*') and filename not in written:
+            os.remove(os.path.join(cache.directory, filename))
+
+    return time.time() - start
+
+
+def bench_cold_start():
+    """Return the seconds a fresh worker spends loading every template,
+    without and with the bytecode cache."""
+
+    uncached = app.create_jinja_environment()
+    uncached.bytecode_cache = None
+
+    seconds = load_templates(uncached)
+
+    compile_templates()
+
+    return seconds, load_templates(app.create_jinja_environment())
+
+
+BENCH_PAGE = """{%% from "macros.html" import book_card %s %%}
+{%% for book in books %%}{{ book_card(book) }}{%% endfor %%}"""
+
+
+def bench_render(count, renders=100):
+    """Return the seconds per render of a page of count book cards, with
+    macros imported with and without context."""
+
+    book = {'id': 1, 'title': 'Title', 'author': 'Author', 'cover': None,
+            'url': 'http://example.com/', 'sets': [{'id': 1, 'title': 'Set'}]}
+
+    books = [book] * count
+
+    results = []
+
+    with app.test_request_context():
+        for context in ('with context', ''):
+            page = app.jinja_env.from_string(BENCH_PAGE % context)
+
+            start = time.time()
+
+            for i in range(renders):
+                page.render(books=books)
+
+            results.append((time.time() - start) / renders)
+
+    return tuple(results)
@@ -1,15 +1,78 @@
 import md5
+import re
+import socket
 
 from flask import flash
 from itsdangerous import URLSafeTimedSerializer
 import mandrill
+import requests
 
-from . import app
+try:
+    import gevent
+    import gevent.local
+    import gevent.socket
+except ImportError:
+    gevent = None
+
+from . import app, db, sharding
 
 
 ts = URLSafeTimedSerializer(app.config["SECRET_KEY"])
 
+class TimeoutSession(requests.Session):
+    """A session whose requests time out after a default number of seconds."""
+
+    def __init__(self, timeout):
+        requests.Session.__init__(self)
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return requests.Session.request(self, *args, **kwargs)
+
+
 mandrill_client = mandrill.Mandrill(app.config["MANDRILL_KEY"])
+mandrill_client.session = TimeoutSession(app.config["MAIL_TIMEOUT"])
+
+
+def cooperative():
+    """Return whether we're running in a gevent worker with patched sockets."""
+
+    return gevent is not None and socket.socket is gevent.socket.socket
+
+
+def run_blocking(f, *args):
+    """Call f, on gevent's thread pool when running cooperatively.
+
+    For CPU bound calls such as bcrypt that would otherwise stall every
+    other greenlet in the worker.
+
+    """
+
+    if cooperative():
+        return gevent.get_hub().threadpool.apply(f, args)
+
+    return f(*args)
+
+
+def check_greenlet_locals():
+    """Raise if thread locals would be shared between the greenlets of a
+    worker, as they are when gevent patched threading after bookends was
+    imported. db.session is scoped per greenlet either way, but
+    sharding._local is a threading.local.
+
+    """
+
+    if not isinstance(sharding._local, gevent.local.local):
+        raise RuntimeError("sharding._local is shared between greenlets; "
+                           "gevent must patch threading before bookends is imported")
+
+
+@app.before_first_request
+def check_cooperative_mode():
+    if cooperative():
+        check_greenlet_locals()
+
 
 def flash_errors(form):
     for field, errors in form.errors.items():
@@ -20,6 +83,8 @@ def flash_errors(form):
 
 
 def send_email(to_email, subject, html):
+    """Send an email through Mandrill and return the result, or None if it
+    couldn't be sent."""
 
     message = {
         'html': html,
@@ -29,9 +94,11 @@ def send_email(to_email, subject, html):
         'to': [{'email': to_email}]
     }
 
-    result = mandrill_client.messages.send(message=message)
-
-    return result
+    try:
+        return mandrill_client.messages.send(message=message)
+    except (mandrill.Error, requests.RequestException):
+        app.logger.exception("Couldn't send email to %s", to_email)
+        return None
 
 def md5hash(string):
     """Return the hex digest of an MD5 hash of a string (for Gravatar)."""
@@ -41,3 +108,13 @@ def md5hash(string):
     m.update(string)
 
     return m.hexdigest()
+
+def fingerprint(title, author):
+    """Return a key that's equal for books that differ only in case,
+    punctuation or spacing."""
+
+    def normalize(text):
+        text = re.sub(r'[^\w\s]', u'', (text or u'').lower(), flags=re.UNICODE)
+        return u' '.join(text.split())
+
+    return md5hash((normalize(title) + u'|' + normalize(author)).encode('utf-8'))
@@ -1,16 +1,17 @@
 from datetime import datetime, timedelta
 import json
+import re
 
-from flask import render_template, flash, redirect, url_for, abort, request
+from flask import render_template, flash, redirect, url_for, abort, request, jsonify
 
 from flask.ext.login import login_required, login_user, current_user, logout_user, confirm_login, fresh_login_required
 
-from . import app, db, util
+from . import app, db, util, sharding, lock_library
 from .forms import (AccountCreateForm, AccountRecoverForm,
                     PasswordForm, SignInForm, AddEditBookForm,
                     ChangeEmailForm, DeleteBookForm, BillingForm, StopBillingForm,
                     AccountDeleteForm )
-from .models import User, Book, Set
+from .models import User, Book, Set, book_rows
 
 
 @app.route('/')
@@ -22,8 +23,7 @@ def index():
 
     return render_template(
         "app_index.html",
-        books_exciting=Book.query.filter_by(user_id=current_user.id, exciting=True).all(),
-        books_reading=Book.query.filter_by(user_id=current_user.id, reading=True).all()
+        dashboard=current_user.get_dashboard()
     )
 
 
@@ -45,11 +45,15 @@ def create_account():
             password = form.password.data
         )
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()
 
-        user.send_activation_email()
+        user.shard = sharding.shard_for_user_id(user.id)
+        db.session.commit()
 
-        flash("Your account has been created. Check your email for your activation link.")
+        if user.send_activation_email() is None:
+            flash("Your account has been created, but we couldn't send your activation email. Please try again later.")
+        else:
+            flash("Your account has been created. Check your email for your activation link.")
         return redirect(url_for("index"))
 
     return render_template("accounts/create.html", form=form)
@@ -87,9 +91,10 @@ def recover_account():
     form = AccountRecoverForm()
     if form.validate_on_submit():
         user = User.get(email=form.email.data)
-        user.send_recover_email()
-
-        flash("Check your email for an account recovery link.")
+        if user.send_recover_email() is None:
+            flash("We couldn't send your account recovery email. Please try again later.")
+        else:
+            flash("Check your email for an account recovery link.")
 
         return redirect(url_for('index'))
 
@@ -160,11 +165,12 @@ def signout():
 def books():
     """ List the current user's books. """
 
-    return render_template('books/index.html', books=current_user.books)
+    return render_template('books/index.html', books=book_rows(current_user.books))
 
 
 @app.route('/books/add', methods=["GET", "POST"])
 @login_required
+@lock_library
 def add_book():
     """Add a book."""
 
@@ -172,7 +178,12 @@ def add_book():
 
     if form.validate_on_submit():
 
+        duplicate = current_user.books.filter_by(
+            fingerprint=util.fingerprint(form.title.data, form.author.data)
+        ).first()
+
         book = Book(
+            user_id=current_user.id,
             title=form.title.data,
             author=form.author.data,
             url=form.url.data,
@@ -186,17 +197,26 @@ def add_book():
         current_user.books.append(book)
 
         db.session.add(current_user)
+        current_user.log_change(book)
+        current_user.update_dashboard()
         db.session.commit()
 
         flash(book.title + " has been added.")
 
+        if duplicate:
+            flash("You already had a copy of " + duplicate.title + ".")
+
         return redirect(url_for('add_book'))
 
-    return render_template('books/add.html', form=form)
+    suggested_sets = current_user.get_set_graph().suggest([])
+
+    return render_template('books/add.html', form=form,
+        suggested_sets=suggested_sets)
 
 
 @app.route('/books/edit/<int:book_id>', methods=["GET", "POST"])
 @login_required
+@lock_library
 def edit_book(book_id):
     """Edit the book with a given id.
 
@@ -213,6 +233,10 @@ def edit_book(book_id):
 
     if form.validate_on_submit():
 
+        if book.url != form.url.data:
+            book.cover = None
+            book.enriched = False
+
         book.title = form.title.data
         book.author = form.author.data
         book.url = form.url.data
@@ -223,6 +247,8 @@ def edit_book(book_id):
         book.update_sets(form.sets.data)
 
         db.session.add(book)
+        current_user.log_change(book)
+        current_user.update_dashboard()
 
         db.session.commit()
 
@@ -230,18 +256,27 @@ def edit_book(book_id):
 
         return redirect(url_for('index'))
 
-    return render_template('books/edit.html', book=book, form=form, delete_form=DeleteBookForm())
+    suggested_sets = current_user.get_set_graph().suggest(
+        [set.id for set in book.sets])
+
+    return render_template('books/edit.html', book=book, form=form,
+        delete_form=DeleteBookForm(), suggested_sets=suggested_sets)
 
 
 @app.route('/books/delete/<int:book_id>', methods=["POST"])
 @login_required
+@lock_library
 def delete_book(book_id):
     form = DeleteBookForm()
 
     if form.validate_on_submit():
         book = Book().query.filter_by(id=book_id, user_id=current_user.id).first_or_404()
 
+        book.update_sets('')
+
         db.session.delete(book)
+        current_user.log_change(book, deleted=True)
+        current_user.update_dashboard()
         db.session.commit()
 
         flash(book.title + " was deleted.")
@@ -264,7 +299,33 @@ def view_set(set_id):
 
     set = Set().query.filter_by(id=set_id, user_id=current_user.id).first_or_404()
 
-    return render_template('/sets/view.html', set=set)
+    return render_template('/sets/view.html', set=set, books=book_rows(set.books))
+
+
+@app.route('/api/sync')
+@login_required
+def api_sync():
+    """Return the books changed since the `since` cursor, for delta sync.
+
+    Pages of a full resync are asked for with `after`.
+
+    """
+
+    since = request.args.get('since', 0, type=int)
+    after = request.args.get('after', 0, type=int)
+
+    return jsonify(current_user.changes_since(since,
+        app.config['SYNC_PAGE_SIZE'], after))
+
+
+@app.route('/api/sets/suggest')
+@login_required
+def api_suggest_sets():
+    """Suggest sets for a book in the given `sets`, e.g. {Magic} {Fantasy}."""
+
+    titles = re.findall(r"\{(.+?)\}", request.args.get('sets', ''))
+
+    return jsonify(sets=current_user.get_set_graph().suggest_for_titles(titles))
 
 
 @app.route('/accounts/refresh', methods=["GET", "POST"])
@@ -307,9 +368,10 @@ def account_email():
     form = ChangeEmailForm()
 
     if form.validate_on_submit():
-        current_user.send_email_update_email(form.email.data)
-
-        flash("Check your new email address to confirm the update.")
+        if current_user.send_email_update_email(form.email.data) is None:
+            flash("We couldn't send an email to your new address. Please try again later.")
+        else:
+            flash("Check your new email address to confirm the update.")
 
         return redirect(url_for('index'))
 
@@ -340,13 +402,7 @@ def account_delete():
 
     if form.validate_on_submit():
 
-        if current_user.stripe_id:
-
-            customer = stripe.Customer.retrieve(current_user.stripe_id)
-
-            customer.delete()
-
-        db.session.delete(current_user)
+        current_user.delete()
         db.session.commit()
 
         logout_user()
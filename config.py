@@ -3,3 +3,37 @@ BCRYPT_LEVEL = 13
 
 MAIL_FROM_EMAIL = "robert@getbookends.com"
 MAIL_FROM_NAME = "Robert Picard"
+MAIL_TIMEOUT = 10
+
+# Accounts with more books than this are tombstoned on deletion and purged
+# in chunks of PURGE_CHUNK_SIZE rows by `manage.py purge`.
+ACCOUNT_PURGE_THRESHOLD = 500
+PURGE_CHUNK_SIZE = 1000
+
+# SQLALCHEMY_BINDS keys of the databases holding the book, set and sets
+# tables, partitioned by user id. Empty keeps them in the main database.
+BOOK_SHARDS = []
+
+# Most change log entries read per /api/sync response, and how long deletions
+# are kept by `manage.py compact_changes` before clients must fully resync.
+SYNC_PAGE_SIZE = 500
+CHANGELOG_RETENTION_DAYS = 90
+
+# Book url metadata fetching, run by `manage.py enrich`.
+METADATA_WORKERS = 8
+METADATA_TIMEOUT = 5
+METADATA_HOST_INTERVAL = 1.0
+METADATA_MAX_BYTES = 256 * 1024
+METADATA_TTL_DAYS = 7
+# Let the fetcher read loopback and private addresses, for a local server.
+METADATA_ALLOW_PRIVATE_HOSTS = False
+
+# Where compiled templates are cached; defaults to instance/jinja_cache.
+JINJA_CACHE_DIR = None
+
+# Stripe requests made by bookends.payments.
+STRIPE_API_BASE = "https://api.stripe.com"
+STRIPE_TIMEOUT = 10
+STRIPE_RETRIES = 3
+STRIPE_RETRY_BACKOFF = 0.5
+STRIPE_POOL_SIZE = 10
@@ -0,0 +1,25 @@
+"""gunicorn settings for the cooperative (gevent) worker mode.
+
+    gunicorn -c gunicorn_gevent.py bookends:app
+
+Each worker serves up to worker_connections requests at once. Keep
+SQLALCHEMY_POOL_SIZE in instance/config.py near the number of requests you
+expect to be waiting on the database at the same time.
+
+"""
+
+worker_class = 'gevent'
+
+workers = 2
+
+worker_connections = 200
+
+# bookends must be imported after gevent has patched the worker so that
+# thread locals, and with them db.session, are per greenlet.
+preload_app = False
+
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
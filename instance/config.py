@@ -0,0 +1,5 @@
+SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/bookends_main.db'
+MANDRILL_KEY = 'x'
+SECRET_KEY = 'secret'
+STRIPE_API_KEY = 'sk_test'
+STRIPE_PUBLISHABLE_KEY = 'pk_test'
@@ -0,0 +1,144 @@
+"""Bookends management commands.
+
+Usage:
+  manage.py purge [--chunk-size=<n>]
+  manage.py create_shards
+  manage.py rebalance
+  manage.py compact_changes
+  manage.py enrich [--batch-size=<n>]
+  manage.py query_budget
+  manage.py compile_templates
+  manage.py bench_templates [--books=<n>]
+  manage.py bench_listing [--books=<n>]
+  manage.py delete_stripe_customers
+  manage.py dedupe [--chunk-size=<n>]
+  manage.py fake_stripe [--port=<n>]
+  manage.py check_stripe
+  manage.py check_shards
+  manage.py check_metadata
+  manage.py check_soak
+  manage.py soak <url> [--connections=<n>] [--requests=<n>]
+
+Options:
+  --chunk-size=<n>  Rows per batch for purge and dedupe (PURGE_CHUNK_SIZE).
+  --batch-size=<n>  Books to enrich per batch [default: 100].
+  --connections=<n> Concurrent connections for soak [default: 50].
+  --requests=<n>    Total requests for soak [default: 2000].
+  --books=<n>       Book cards per rendered page [default: 100].
+  --port=<n>        Port for fake_stripe [default: 12111].
+
+"""
+from datetime import timedelta
+import sys
+
+from docopt import docopt
+
+from bookends import (app, sharding, metadata, querybudget, templating,
+                      payments, fakestripe, fakepages, dedupe, benchmarks,
+                      soak)
+from bookends.models import User, Change
+
+
+def chunk_size(arguments):
+    if arguments['--chunk-size'] is None:
+        return app.config['PURGE_CHUNK_SIZE']
+    return int(arguments['--chunk-size'])
+
+
+def query_budget():
+    """Print the statements each route emits and exit 1 if any fail."""
+
+    results = querybudget.run()
+
+    for route, counts, failure in results:
+        print '%-28s %-4s %-10s budget %-3d %s' % (
+            route.endpoint, route.method,
+            ' '.join(str(count) for count in counts),
+            route.budget, failure or 'ok')
+
+    if any(failure for route, counts, failure in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['query_budget']:
+        query_budget()
+        sys.exit()
+
+    if arguments['bench_listing']:
+        for name, (loaded, rendered, size) in zip(('ORM', 'Rows'),
+                benchmarks.bench_listing(int(arguments['--books']))):
+            print '%-4s load %.1fms, render %.1fms, ~%d bytes per book' % (
+                name, loaded * 1000, rendered * 1000, size)
+        sys.exit()
+
+    if arguments['fake_stripe']:
+        fakestripe.create_server(int(arguments['--port'])).serve_forever()
+
+    if arguments['check_shards']:
+        problems = sharding.check()
+        for problem in problems:
+            print problem
+        print 'Book storage shards: %s' % ('failed' if problems else 'ok')
+        sys.exit(1 if problems else 0)
+
+    if arguments['check_metadata']:
+        problems = fakepages.check()
+        for problem in problems:
+            print problem
+        print 'Metadata fetcher: %s' % ('failed' if problems else 'ok')
+        sys.exit(1 if problems else 0)
+
+    if arguments['check_soak']:
+        problems = soak.check()
+        for problem in problems:
+            print problem
+        print 'Gevent workers: %s' % ('failed' if problems else 'ok')
+        sys.exit(1 if problems else 0)
+
+    if arguments['soak']:
+        rate, errors = soak.measure(arguments['<url>'],
+            int(arguments['--connections']), int(arguments['--requests']))
+        print '%s requests over %s connections: %.1f req/s, %d errors' % (
+            arguments['--requests'], arguments['--connections'], rate, errors)
+        sys.exit(1 if errors else 0)
+
+    if arguments['check_stripe']:
+        problems = fakestripe.check()
+        for problem in problems:
+            print problem
+        print 'Stripe customer deletion: %s' % ('failed' if problems else 'ok')
+        sys.exit(1 if problems else 0)
+
+    with app.app_context():
+        if arguments['purge']:
+            User.purge_deleted(chunk_size(arguments))
+        elif arguments['create_shards']:
+            sharding.create_shards()
+        elif arguments['rebalance']:
+            for user, source, target in sharding.rebalance():
+                print 'Moved user %s from %s to %s' % (
+                    user.id, source or 'main', target or 'main')
+            print 'Removed stray rows of %s users' % sharding.sweep()
+        elif arguments['compact_changes']:
+            Change.compact(timedelta(days=app.config['CHANGELOG_RETENTION_DAYS']))
+        elif arguments['enrich']:
+            fetcher = metadata.create_fetcher()
+            for count in metadata.enrich_books(fetcher, int(arguments['--batch-size'])):
+                print 'Enriched %s books' % count
+        elif arguments['compile_templates']:
+            print 'Compiled templates in %.3fs' % templating.compile_templates()
+        elif arguments['bench_templates']:
+            print 'Loading all templates: %.3fs uncached, %.3fs from bytecode' % (
+                templating.bench_cold_start())
+            print 'Rendering %s book cards: %.2fms with context, %.2fms without' % (
+                (arguments['--books'],) + tuple(seconds * 1000 for seconds in
+                    templating.bench_render(int(arguments['--books']))))
+        elif arguments['delete_stripe_customers']:
+            for deletion, error in payments.process_customer_deletions():
+                print 'Customer %s: %s' % (deletion.stripe_id, error or 'deleted')
+        elif arguments['dedupe']:
+            for count in dedupe.dedupe(chunk_size(arguments)):
+                print 'Merged %s duplicate books' % count